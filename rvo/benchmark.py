@@ -0,0 +1,350 @@
+"""Benchmark the generators on a generated fake website
+
+Usage: ``rvo-benchmark --sizes small medium --output results.json``. Every
+corpus size is generated in a temporary directory and then built twice: the
+first ("cold") run starts without caches, the second ("warm") one has them.
+
+The import time of the console script modules is checked against a budget
+(with ``python -X importtime``), too. The exit code is 1 if a module is
+too slow or imports something heavy it shouldn't need at import time.
+
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from rvo import sitemap, templating, utils, videos
+from rvo.rst import setup_for_plain_docutils
+from rvo.sermonlog import Sermonlog
+from rvo.weblog import Weblog
+
+# name: (years, weblog posts per year, sermons per year, videos per year,
+# html files in build/html)
+SIZES = {
+    "small": (3, 20, 10, 5, 200),
+    "medium": (10, 100, 30, 20, 2000),
+    "large": (20, 300, 50, 50, 10000),
+}
+FIRST_YEAR = 2000
+TAGS = [
+    "python",
+    "django",
+    "plone",
+    "zope",
+    "book",
+    "djangocon",
+    "pyramid",
+    "buildout",
+    "faith",
+    "history",
+    "bicycle",
+    "nelenschuurs",
+]
+KERKEN = ["Hervormde kerk", "Gereformeerde kerk", "Dorpskerk", "Grote kerk"]
+PREDIKANTEN = ["Ds. Jansen", "Ds. de Vries", "Ds. Bakker", "Ds. Visser"]
+SERMON_TAGS = ["genade", "geloof", "hoop", "liefde", "advent", "pasen"]
+ENTRY_TEMPLATE = """\
+{title}
+{underline}
+
+.. tags:: {tags}
+
+Some *introductory* text for entry {number}, with a `link
+<https://reinout.vanrees.org/>`_.
+
+- A list item.
+- Another list item with ``code``.
+
+A section
+---------
+
+{paragraph}
+"""
+SERMON_TEMPLATE = """\
+{title}
+{underline}
+
+.. preek::
+   :kerk: {kerk}
+   :predikant: {predikant}
+   :tekst: Johannes 3:16; Romeinen 8:28
+   :datum: {datum}
+   :toegevoegd: {datum}
+   :tags: {tags}
+
+{paragraph}
+"""
+VIDEO_TEMPLATE = """\
+title = "{title}"
+youtube = "https://www.youtube.com/watch?v={id}"
+"""
+# module: maximum cumulative import time in milliseconds.
+IMPORT_BUDGETS = {
+    "rvo.homepage": 100,
+    "rvo.sermonlog": 100,
+    "rvo.sitemap": 100,
+    "rvo.videos": 100,
+    "rvo.weblog": 100,
+}
+# Packages that should only be imported when actually used.
+HEAVY_PACKAGES = {"docutils", "jinja2", "sphinx"}
+IMPORT_RUNS = 3
+PARAGRAPH = " ".join(["Lorem ipsum dolor sit amet, consectetur adipiscing."] * 8)
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as output:
+        output.write(content)
+
+
+def generate_weblog(rootdir, years, posts_per_year, rng):
+    weblogdir = os.path.join(rootdir, "source", "weblog")
+    # Existing tag files, otherwise the tag page creation asks questions.
+    for tag in TAGS:
+        write(os.path.join(weblogdir, "tags", f"{tag}.txt"), "")
+    number = 0
+    for year in range(FIRST_YEAR, FIRST_YEAR + years):
+        for _ in range(posts_per_year):
+            number += 1
+            month = rng.randint(1, 12)
+            day = rng.randint(1, 28)
+            title = f"Weblog entry number {number}"
+            write(
+                os.path.join(
+                    weblogdir, str(year), f"{month:02d}", f"{day:02d}", f"e{number}.txt"
+                ),
+                ENTRY_TEMPLATE.format(
+                    title=title,
+                    underline="#" * len(title),
+                    tags=", ".join(rng.sample(TAGS, rng.randint(1, 3))),
+                    number=number,
+                    paragraph=PARAGRAPH,
+                ),
+            )
+    os.makedirs(os.path.join(rootdir, "build", "html", "weblog"), exist_ok=True)
+    return number
+
+
+def generate_sermons(rootdir, years, sermons_per_year, rng):
+    sermonlogdir = os.path.join(rootdir, "source", "preken")
+    for subdir in ["kerken", "predikanten", "tags"]:
+        os.makedirs(os.path.join(sermonlogdir, subdir), exist_ok=True)
+    for year in range(FIRST_YEAR, FIRST_YEAR + years):
+        for number in range(sermons_per_year):
+            title = f"Preek {number} uit {year}"
+            datum = f"{year}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+            write(
+                os.path.join(sermonlogdir, str(year), f"preek{number}.txt"),
+                SERMON_TEMPLATE.format(
+                    title=title,
+                    underline="=" * len(title),
+                    kerk=rng.choice(KERKEN),
+                    predikant=rng.choice(PREDIKANTEN),
+                    datum=datum,
+                    tags=", ".join(rng.sample(SERMON_TAGS, 2)),
+                    paragraph=PARAGRAPH,
+                ),
+            )
+    return sermonlogdir
+
+
+def generate_videos(rootdir, years, videos_per_year):
+    metadata_dir = os.path.join(rootdir, "videos")
+    for year in range(FIRST_YEAR, FIRST_YEAR + years):
+        for number in range(videos_per_year):
+            write(
+                os.path.join(metadata_dir, str(year), f"video{number}.toml"),
+                VIDEO_TEMPLATE.format(title=f"Video {number}", id=f"v{year}{number}"),
+            )
+    os.makedirs(os.path.join(rootdir, "source", "videos"), exist_ok=True)
+    return metadata_dir
+
+
+def generate_html(rootdir, html_files):
+    htmldir = os.path.join(rootdir, "build", "html")
+    for number in range(html_files):
+        subdir = os.path.join(htmldir, f"section{number % 20}", f"sub{number % 7}")
+        write(os.path.join(subdir, f"page{number}.html"), "<html></html>")
+    for skipped in ["_static/style.css", "_sources/index.txt", "searchindex.js"]:
+        write(os.path.join(htmldir, skipped), "")
+
+
+def generate_corpus(rootdir, years, posts, sermons, videos_per_year, html_files):
+    """Generate a fake website in rootdir. Return the number of entries."""
+    rng = random.Random(42)
+    generate_sermons(rootdir, years, sermons, rng)
+    generate_videos(rootdir, years, videos_per_year)
+    generate_html(rootdir, html_files)
+    return generate_weblog(rootdir, years, posts, rng)
+
+
+class Timer:
+    """Collect durations of named stages"""
+
+    def __init__(self):
+        self.timings = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        yield
+        self.timings[name] = round(time.perf_counter() - start, 4)
+
+
+def time_stages(rootdir):
+    """Run the generators in rootdir (which must be the cwd), return timings"""
+    timer = Timer()
+    # The utils write manifest and the jinja environment (with its bytecode
+    # cache) are per-process: start afresh for this corpus.
+    utils.reset_manifest()
+    templating.get_environment.cache_clear()
+    weblog = Weblog(rootdir)
+    with timer.stage("weblog.assign_entries"):
+        weblog.assign_entries()
+    with timer.stage("weblog.create_files"):
+        weblog.create_files()
+    with timer.stage("weblog.create_atom"):
+        weblog.create_atom()
+    with timer.stage("weblog.create_stats"):
+        weblog.create_stats()
+
+    sermonlog = Sermonlog(os.path.join(rootdir, "source", "preken"))
+    with timer.stage("sermonlog.collect_entries"):
+        sermonlog.collect_entries()
+    with timer.stage("sermonlog.write_overviews"):
+        sermonlog.write_years()
+        sermonlog.write_index()
+        sermonlog.write_overviews()
+
+    with timer.stage("sitemap.files"):
+        list(sitemap.files())
+
+    videos.METADATA_DIR = Path(rootdir, "videos")
+    videos.OUTPUT_DIR = Path(rootdir, "source", "videos")
+    with timer.stage("videos.main"):
+        videos.main()
+    utils.save_manifest()
+    return timer.timings
+
+
+def import_time(module):
+    """Return cumulative import time (ms) and the imported modules"""
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    # Lines look like "import time:  self [us] | cumulative | imported package".
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _self, cumulative, name = line.removeprefix("import time:").split("|")
+        if not cumulative.strip().isdigit():
+            # The header line.
+            continue
+        times[name.strip()] = int(cumulative) / 1000
+    return times[module], set(times)
+
+
+def check_imports(budgets=IMPORT_BUDGETS):
+    """Return import timings per module and a list of budget violations"""
+    results = {}
+    problems = []
+    for module, budget in budgets.items():
+        # The fastest run is the least disturbed one.
+        runs = [import_time(module) for _ in range(IMPORT_RUNS)]
+        milliseconds = min(run[0] for run in runs)
+        imported = {name.split(".")[0] for name in runs[0][1]}
+        heavy = sorted(imported & HEAVY_PACKAGES)
+        results[module] = {
+            "milliseconds": round(milliseconds, 1),
+            "budget": budget,
+            "heavy": heavy,
+        }
+        print(f"import {module}: {milliseconds:.1f} ms (budget {budget} ms)")
+        if milliseconds > budget:
+            problems.append(f"{module} takes {milliseconds:.1f} ms to import")
+        if heavy:
+            problems.append(f"{module} imports {', '.join(heavy)}")
+    return results, problems
+
+
+def run_benchmark(sizes):
+    results = []
+    original_dir = os.getcwd()
+    for size in sizes:
+        with tempfile.TemporaryDirectory(prefix=f"rvo-benchmark-{size}-") as rootdir:
+            number = generate_corpus(rootdir, *SIZES[size])
+            os.chdir(rootdir)
+            try:
+                for run in ["cold", "warm"]:
+                    # The generators are quite chatty.
+                    with (
+                        contextlib.redirect_stdout(io.StringIO()),
+                        contextlib.redirect_stderr(io.StringIO()),
+                    ):
+                        timings = time_stages(rootdir)
+                    results.append(
+                        {
+                            "size": size,
+                            "entries": number,
+                            "run": run,
+                            "timings": timings,
+                        }
+                    )
+                    print(f"{size} ({number} entries, {run}): {timings}")
+            finally:
+                os.chdir(original_dir)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        choices=list(SIZES),
+        default=["small", "medium"],
+        help="corpus sizes to benchmark (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--output",
+        default="benchmark-results.json",
+        help="json file to write the results to (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--imports-only",
+        action="store_true",
+        help="only check the import times, don't benchmark the corpus sizes",
+    )
+    options = parser.parse_args()
+    import_results, problems = check_imports()
+    if not options.imports_only:
+        setup_for_plain_docutils()
+        results = {
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "imports": import_results,
+            "results": run_benchmark(options.sizes),
+        }
+        with open(options.output, "w") as output:
+            json.dump(results, output, indent=2)
+        print(f"Wrote {options.output}")
+    for problem in problems:
+        print(f"Import budget exceeded: {problem}")
+    if problems:
+        sys.exit(1)
@@ -0,0 +1,200 @@
+"""Build the whole website in one process
+
+Usage: ``rvo build``, inside the ``docs/`` directory. This does what ``make
+html`` does with six separate scripts: generate the weblog, sermonlog and
+video pages, run sphinx, write the homepage and the sitemap. Everything is
+imported only once and the weblog snippet for the homepage is passed along
+in memory.
+
+The stages form a dependency graph: the weblog, sermonlog and videos don't
+depend on each other, so they run concurrently. Sphinx runs on the main
+thread once they're done, as its parallel builder forks.
+
+``rvo watch`` keeps the weblog and sermonlog pages up to date while you
+edit, see rvo.watch.
+
+"""
+
+import argparse
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from rvo import sitemap, stats, utils, videos
+from rvo.cache import cache_file
+from rvo.homepage import Homepage
+from rvo.instrument import Instrumentation
+from rvo.rst import setup_for_plain_docutils
+from rvo.sermonlog import Sermonlog
+from rvo.watch import POLL_INTERVAL, Watch
+from rvo.weblog import Weblog
+
+logger = logging.getLogger(__name__)
+
+SOURCE_DIR = "source"
+HTML_DIR = "build/html"
+DOCTREE_DIR = "build/doctrees"
+# Number of sphinx processes, our rvo.rst extension is parallel safe.
+SPHINX_JOBS = "auto"
+# stage name: stages it depends on.
+STAGES = {
+    "weblog": [],
+    "sermonlog": [],
+    "videos": [],
+    "sphinx": ["weblog", "sermonlog", "videos"],
+    "homepage": ["weblog", "sphinx"],
+    "sitemap": ["sphinx", "homepage"],
+}
+# Stages that run on the main thread, with no other threads around. Sphinx'
+# parallel builder forks, which can deadlock a multi-threaded process.
+MAIN_THREAD_STAGES = ["sphinx"]
+
+
+class Build:
+    """Run the build stages, sharing their results in memory"""
+
+    def __init__(self, stages=None, incremental=False, sphinx_options=None):
+        self.stages = stages or list(STAGES)
+        self.incremental = incremental
+        self.sphinx_options = sphinx_options or []
+        self.instrumentation = Instrumentation("build")
+        self.weblog = None
+        self.homepage_snippet = None
+
+    def ready(self, done, running):
+        """Yield the stages whose dependencies are done"""
+        # STAGES is in dependency order, so one pass also gets stages after
+        # a skipped one going.
+        for name, dependencies in STAGES.items():
+            if name in done or name in running.values():
+                continue
+            if not all(dependency in done for dependency in dependencies):
+                continue
+            if name not in self.stages:
+                done.add(name)
+                continue
+            yield name
+
+    def run(self):
+        """Start every stage as soon as the stages it depends on are done"""
+        done = set()
+        running = {}
+        executor = None
+        try:
+            while len(done) < len(STAGES):
+                for name in self.ready(done, running):
+                    if name not in MAIN_THREAD_STAGES:
+                        if executor is None:
+                            executor = ThreadPoolExecutor(max_workers=len(STAGES))
+                        running[executor.submit(self.run_stage, name)] = name
+                    elif not running:
+                        if executor is not None:
+                            # Also get rid of the idle worker threads.
+                            executor.shutdown()
+                            executor = None
+                        self.run_stage(name)
+                        done.add(name)
+                    # Otherwise wait till the other stages are finished.
+                if not running:
+                    continue
+                finished, _not_done = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    # Re-raises a stage's exception.
+                    future.result()
+                    done.add(running.pop(future))
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        self.instrumentation.save()
+
+    def run_stage(self, name):
+        logger.info("Starting %s", name)
+        # Stages can overlap, so the memory/file counts of concurrent
+        # stages get mixed up.
+        with self.instrumentation.stage(name):
+            getattr(self, f"build_{name}")()
+        logger.info("Finished %s", name)
+
+    def build_weblog(self):
+        self.weblog = Weblog(".", incremental=self.incremental)
+        self.weblog.assign_entries()
+        logger.info(self.weblog.entry_cache.report())
+        self.weblog.create_files()
+        self.weblog.create_atom()
+        logger.info(self.weblog.render_cache.report())
+        self.homepage_snippet = self.weblog.create_for_homepage()
+        self.weblog.create_stats(granularity=stats.MONTH)
+
+    def build_sermonlog(self):
+        sermonlog = Sermonlog(f"{SOURCE_DIR}/preken", incremental=self.incremental)
+        sermonlog.collect_entries()
+        sermonlog.write_years()
+        sermonlog.write_index()
+        sermonlog.write_overviews()
+        sermonlog.save_membership()
+
+    def build_videos(self):
+        videos.write_videos()
+
+    def build_sphinx(self):
+        # Imported here as it is only needed in this single stage.
+        from sphinx.cmd.build import build_main
+
+        arguments = ["-b", "html", "-d", DOCTREE_DIR, "-j", SPHINX_JOBS]
+        arguments += self.sphinx_options + [SOURCE_DIR, HTML_DIR]
+        if build_main(arguments):
+            raise RuntimeError("sphinx-build failed")
+
+    def build_homepage(self):
+        Homepage(weblogsnippet=self.homepage_snippet).write()
+
+    def build_sitemap(self):
+        lastmod_cache = sitemap.LastmodCache(cache_file("sitemap-lastmod.json"))
+        sitemap.write_sitemaps(sitemap.files(lastmod_cache=lastmod_cache))
+        lastmod_cache.prune()
+        lastmod_cache.save()
+        logger.info(lastmod_cache.report())
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="build the whole website")
+    build_parser.add_argument(
+        "--stages",
+        nargs="+",
+        choices=list(STAGES),
+        help="only run these stages (default: all of them)",
+    )
+    build_parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only regenerate weblog/sermonlog pages whose entries changed",
+    )
+    build_parser.add_argument(
+        "--sphinx-option",
+        action="append",
+        dest="sphinx_options",
+        help="extra option for sphinx-build, like --sphinx-option=-W (repeatable)",
+    )
+    watch_parser = subparsers.add_parser(
+        "watch", help="regenerate weblog/sermonlog pages when entries change"
+    )
+    watch_parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=POLL_INTERVAL,
+        help="seconds between checks without inotify (default: %(default)s)",
+    )
+    options = parser.parse_args()
+    setup_for_plain_docutils()
+    if options.command == "watch":
+        Watch(poll_interval=options.poll_interval).run()
+        return
+    build = Build(
+        stages=options.stages,
+        incremental=options.incremental,
+        sphinx_options=options.sphinx_options,
+    )
+    build.run()
+    logger.info(utils.save_manifest())
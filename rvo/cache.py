@@ -0,0 +1,163 @@
+"""Json-file based caches, stored in build/cache/"""
+
+import hashlib
+import json
+import os
+import threading
+
+
+def cache_file(name, rootdir="."):
+    """Return path of a cache file inside build/cache/"""
+    return os.path.join(rootdir, "build", "cache", name)
+
+
+def file_hash(path):
+    """Return sha1 of the file's content"""
+    # rvo.utils imports us.
+    from rvo.utils import count_read
+
+    count_read()
+    with open(path, "rb") as hashed_file:
+        return hashlib.file_digest(hashed_file, "sha1").hexdigest()
+
+
+class JsonCache:
+    """Dictionary that is persisted as a json file
+
+    Hits and misses are counted so that we can report how useful the cache
+    actually was.
+
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.hits = 0
+        self.misses = 0
+        self.changed = False
+        self.data = self.load()
+
+    def load(self):
+        try:
+            with open(self.filename) as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            # Missing or corrupt: just start afresh.
+            return {}
+
+    def save(self):
+        """Write the cache back to disk if something changed"""
+        if not self.changed:
+            return
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        temp_filename = self.filename + ".tmp"
+        with open(temp_filename, "w") as cache_file:
+            json.dump(self.data, cache_file)
+        os.replace(temp_filename, self.filename)
+        self.changed = False
+
+    def invalidate(self):
+        """Forget everything, also on disk"""
+        self.data = {}
+        self.changed = False
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def report(self):
+        name = os.path.basename(self.filename)
+        return f"{name}: {self.hits} hits, {self.misses} misses"
+
+
+class MetadataCache(JsonCache):
+    """Metadata extracted from source files, keyed on path, mtime and size
+
+    Only when the file's mtime or size changes do we have to open the file
+    again. Lookups and stores may happen from multiple threads.
+
+    """
+
+    def __init__(self, filename):
+        super().__init__(filename)
+        self.seen = set()
+        self.lock = threading.Lock()
+
+    def lookup(self, path, stat):
+        """Return cached metadata or None if missing/outdated"""
+        with self.lock:
+            self.seen.add(path)
+            cached = self.data.get(path)
+            if (
+                cached
+                and cached["mtime"] == stat.st_mtime_ns
+                and cached["size"] == stat.st_size
+            ):
+                self.hits += 1
+                return cached["metadata"]
+            self.misses += 1
+            return None
+
+    def previous(self, path):
+        """Return the metadata stored last time, even if it is outdated"""
+        with self.lock:
+            cached = self.data.get(path)
+        return cached["metadata"] if cached else None
+
+    def store(self, path, stat, metadata):
+        with self.lock:
+            self.data[path] = {
+                "mtime": stat.st_mtime_ns,
+                "size": stat.st_size,
+                "metadata": metadata,
+            }
+            self.changed = True
+
+    def prune(self):
+        """Remove files we haven't seen (=deleted files) from the cache"""
+        for path in list(self.data):
+            if path not in self.seen:
+                del self.data[path]
+                self.changed = True
+
+
+class RenderCache(JsonCache):
+    """Rendered html, keyed on a hash of the source text
+
+    An edited source text gets a different hash, so it is rendered again.
+    The same goes for every source when one of the ``dependencies`` (files
+    that influence the rendering) changes.
+
+    """
+
+    def __init__(self, filename, dependencies=()):
+        super().__init__(filename)
+        self.used = set()
+        self.salt = ""
+        for dependency in dependencies:
+            if os.path.exists(dependency):
+                self.salt += file_hash(dependency)
+
+    def key(self, source):
+        return hashlib.sha1((self.salt + source).encode("utf-8")).hexdigest()
+
+    def lookup(self, source):
+        """Return cached html or None"""
+        key = self.key(source)
+        self.used.add(key)
+        html = self.data.get(key)
+        if html is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return html
+
+    def store(self, source, html):
+        key = self.key(source)
+        self.used.add(key)
+        self.data[key] = html
+        self.changed = True
+
+    def prune(self):
+        """Remove html that we didn't need this time"""
+        for key in list(self.data):
+            if key not in self.used:
+                del self.data[key]
+                self.changed = True
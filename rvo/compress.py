@@ -0,0 +1,176 @@
+"""Write precompressed .gz (and .br) versions of the files in build/html
+
+The webserver can then serve them as-is (nginx' ``gzip_static`` and
+``brotli_static``) instead of compressing every response. Brotli files are
+only written if the ``brotli`` package is installed.
+
+Files are compressed in parallel. A file whose content hash didn't change
+since the last run isn't compressed again; files with unchanged size and
+mtime aren't even hashed.
+
+"""
+
+import argparse
+import functools
+import gzip
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from rvo import utils
+from rvo.cache import MetadataCache, cache_file, file_hash
+from rvo.instrument import Instrumentation
+
+HTML_DIR = "build/html"
+COMPRESSIBLE_EXTENSIONS = [".html", ".xml", ".js", ".css", ".svg", ".txt", ".json"]
+# Compressing tiny files doesn't gain anything.
+MIN_SIZE = 256
+# Number of processes, None means "number of cpus".
+WORKERS = None
+# Suffixes of the compressed files we (might) write next to the originals.
+COMPRESSED_SUFFIXES = (".gz", ".br")
+
+
+@functools.cache
+def get_brotli():
+    """Return the brotli module, or None if it isn't installed"""
+    # Imported here, so that importing COMPRESSED_SUFFIXES stays cheap.
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def suffixes():
+    """Return the suffixes we actually write"""
+    return COMPRESSED_SUFFIXES if get_brotli() else COMPRESSED_SUFFIXES[:1]
+
+
+def compressible_files(directory=HTML_DIR):
+    """Yield (path, stat) of the files worth compressing"""
+    with os.scandir(directory) as scanned:
+        for item in scanned:
+            if item.is_dir():
+                yield from compressible_files(item.path)
+                continue
+            if os.path.splitext(item.name)[1] not in COMPRESSIBLE_EXTENSIONS:
+                continue
+            stat = item.stat()
+            if stat.st_size >= MIN_SIZE:
+                yield item.path, stat
+
+
+def write_sibling(path, suffix, content, stat):
+    """Write compressed content next to the file, with the same mtime"""
+    target = path + suffix
+    temp_target = target + ".tmp"
+    with open(temp_target, "wb") as compressed_file:
+        compressed_file.write(content)
+    os.utime(temp_target, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.replace(temp_target, target)
+
+
+def compress_file(path, previous_hash):
+    """Compress the file if its content changed, return its hash
+
+    Runs in a worker process.
+
+    """
+    content_hash = file_hash(path)
+    siblings_exist = all(os.path.exists(path + suffix) for suffix in suffixes())
+    if content_hash == previous_hash and siblings_exist:
+        return content_hash, False
+    stat = os.stat(path)
+    with open(path, "rb") as original:
+        content = original.read()
+    # mtime=0: the same content always results in the same .gz file.
+    write_sibling(path, ".gz", gzip.compress(content, compresslevel=9, mtime=0), stat)
+    brotli = get_brotli()
+    if brotli:
+        write_sibling(path, ".br", brotli.compress(content), stat)
+    return content_hash, True
+
+
+class Compressor:
+    """Keep the compressed siblings of build/html up to date"""
+
+    def __init__(self, directory=HTML_DIR, workers=WORKERS):
+        self.directory = directory
+        self.workers = workers
+        # Path -> content hash at the time we compressed it.
+        self.cache = MetadataCache(cache_file("compressed.json"))
+        self.compressed = 0
+        self.skipped = 0
+
+    def run(self):
+        todo = []
+        for path, stat in compressible_files(self.directory):
+            if self.cache.lookup(path, stat) is not None and all(
+                os.path.exists(path + suffix) for suffix in suffixes()
+            ):
+                self.skipped += 1
+                continue
+            todo.append((path, stat, self.cache.previous(path)))
+        if todo:
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                results = executor.map(
+                    compress_file,
+                    [path for path, _stat, _hash in todo],
+                    [previous_hash for _path, _stat, previous_hash in todo],
+                    chunksize=16,
+                )
+                for (path, stat, _hash), (content_hash, compressed) in zip(
+                    todo, results
+                ):
+                    self.cache.store(path, stat, content_hash)
+                    # The workers' reads don't end up in our count: hashing
+                    # is one read, compressing another.
+                    if compressed:
+                        utils.count_read(2)
+                        self.compressed += 1
+                    else:
+                        utils.count_read()
+                        self.skipped += 1
+        self.remove_orphans()
+        self.cache.prune()
+        self.cache.save()
+
+    def remove_orphans(self):
+        """Remove compressed siblings of files that have disappeared"""
+        for path in self.cache.data:
+            if path in self.cache.seen:
+                continue
+            for suffix in COMPRESSED_SUFFIXES:
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+    def report(self):
+        compressed, skipped = self.compressed, self.skipped
+        return f"Compressed {compressed} files, skipped {skipped} unchanged ones"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=WORKERS,
+        help="number of processes for compressing (default: #cpus)",
+    )
+    parser.add_argument(
+        "--clear-cache",
+        action="store_true",
+        help="forget the hashes and compress every file again",
+    )
+    options = parser.parse_args()
+    compressor = Compressor(workers=options.workers)
+    if options.clear_cache:
+        compressor.cache.invalidate()
+    if get_brotli() is None:
+        print("brotli isn't installed, only writing .gz files")
+    instrumentation = Instrumentation("compress")
+    with instrumentation.stage("compress"):
+        compressor.run()
+    print(compressor.cache.report())
+    print(compressor.report())
+    instrumentation.save()
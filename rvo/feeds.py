@@ -0,0 +1,85 @@
+"""Atom feed definitions and the code to fill them with weblog entries"""
+
+import heapq
+import itertools
+
+NUM_FEED_ENTRIES = 10
+
+
+class Feed:
+    """An atom feed: which entries (by tag) end up in which file
+
+    Without tags, every entry is included.
+
+    """
+
+    def __init__(self, filename, tags=None, limit=NUM_FEED_ENTRIES, title=None):
+        self.filename = filename
+        self.tags = set(tags) if tags else None
+        self.limit = limit
+        self.title = title
+
+
+FEEDS = [
+    # Main atom file
+    Feed("atom.xml"),
+    # Planet plone + planet zope
+    Feed(
+        "plonefeed.xml",
+        tags=["plone", "grok", "python", "pyramid", "buildout", "zope"],
+    ),
+    # Planet python
+    Feed(
+        "pythonfeed.xml",
+        tags=[
+            "plone",
+            "grok",
+            "python",
+            "buildout",
+            "django",
+            "pyramid",
+            "djangocon",
+            "zope",
+        ],
+    ),
+    # Django community aggregator
+    Feed("djangofeed.xml", tags=["django", "python", "book", "djangocon"]),
+]
+
+
+def fill_feeds(feeds, entries):
+    """Return {feed filename: newest entries} in a single pass over the entries
+
+    A tag->feeds index tells us which feeds an entry belongs to. Every feed
+    keeps a heap with just its ``limit`` newest entries.
+
+    """
+    untagged = [feed for feed in feeds if feed.tags is None]
+    by_tag = {}
+    for feed in feeds:
+        for tag in feed.tags or []:
+            by_tag.setdefault(tag, []).append(feed)
+    heaps = {feed.filename: [] for feed in feeds}
+    # Tie-breaker so that the heap never has to compare entries themselves.
+    counter = itertools.count()
+
+    for entry in entries:
+        matching = {feed.filename: feed for feed in untagged}
+        for tag in entry.tags:
+            for feed in by_tag.get(tag, []):
+                matching[feed.filename] = feed
+        if not matching:
+            continue
+        newness = (entry.ymd, entry.filename)
+        for feed in matching.values():
+            heap = heaps[feed.filename]
+            item = (newness, next(counter), entry)
+            if len(heap) < feed.limit:
+                heapq.heappush(heap, item)
+            elif newness > heap[0][0]:
+                heapq.heapreplace(heap, item)
+
+    return {
+        filename: [entry for _newness, _count, entry in sorted(heap, reverse=True)]
+        for filename, heap in heaps.items()
+    }
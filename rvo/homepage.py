@@ -1,18 +1,10 @@
 """Script to create index, date and tag pages."""
 
-from jinja2 import Environment, PackageLoader
-
+from rvo.instrument import Instrumentation
+from rvo.templating import get_template
+from rvo.utils import save_manifest, write_if_changed
 from rvo.weblog import utf8_open
 
-jinja_env = Environment(loader=PackageLoader("rvo", "templates"))
-
-
-def conditional_write(filename, new):
-    old = open(filename).read()
-    if new != old:
-        utf8_open(filename, "w").write(new)
-        print(".")
-
 
 def pathto(*args):
     """Mock of sphinx' pathto() just for the homepage.
@@ -25,15 +17,19 @@ def pathto(*args):
 class Homepage:
     """Represents the homepage"""
 
-    template = jinja_env.get_template("homepage.html")
     outfile = "build/html/index.html"
 
-    def __init__(self):
-        pass
+    def __init__(self, weblogsnippet=None):
+        # The build script passes the snippet along, otherwise we read it.
+        self._weblogsnippet = weblogsnippet
+
+    @property
+    def template(self):
+        return get_template("homepage.html")
 
     def write(self):
         """Write out homepage"""
-        conditional_write(self.outfile, self.content)
+        write_if_changed(self.outfile, self.content)
 
     @property
     def content(self):
@@ -49,9 +45,15 @@ class Homepage:
 
     @property
     def weblogsnippet(self):
-        return utf8_open("build/html/weblog/snippet.html").read()
+        if self._weblogsnippet is None:
+            self._weblogsnippet = utf8_open("build/html/weblog/snippet.html").read()
+        return self._weblogsnippet
 
 
 def main():
     homepage = Homepage()
-    homepage.write()
+    instrumentation = Instrumentation("homepage")
+    with instrumentation.stage("write"):
+        homepage.write()
+    print(save_manifest())
+    instrumentation.save()
@@ -0,0 +1,82 @@
+"""Opt-in instrumentation of the stages of our scripts
+
+Set the ``RVO_INSTRUMENT`` environment variable to a json filename to get a
+report with, per stage, the wall time, cpu time, files read/written/skipped
+and the peak (python) memory usage::
+
+    $ RVO_INSTRUMENT=var/instrument.json make html
+
+Every script adds its own section to the file, so one ``make html`` results
+in one report with all the scripts in it.
+
+"""
+
+import contextlib
+import json
+import os
+import time
+import tracemalloc
+
+from rvo import utils
+
+ENVIRONMENT_VARIABLE = "RVO_INSTRUMENT"
+
+
+class Instrumentation:
+    """Measure named stages of one script (if enabled)"""
+
+    def __init__(self, name, report_file=None):
+        self.name = name
+        self.report_file = report_file or os.environ.get(ENVIRONMENT_VARIABLE)
+        self.stages = []
+
+    @property
+    def enabled(self):
+        return bool(self.report_file)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        counts_before = utils.file_counts()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        yield
+        cpu = time.process_time() - cpu_start
+        wall = time.perf_counter() - wall_start
+        _current, peak = tracemalloc.get_traced_memory()
+        counts_after = utils.file_counts()
+        stage = {
+            "name": name,
+            "wall": round(wall, 4),
+            "cpu": round(cpu, 4),
+            "peak_memory_kb": peak // 1024,
+        }
+        for key in counts_after:
+            stage[key] = counts_after[key] - counts_before[key]
+        self.stages.append(stage)
+
+    def save(self):
+        """Add our stages to the json report"""
+        if not self.enabled:
+            return
+        try:
+            with open(self.report_file) as report_file:
+                report = json.load(report_file)
+        except (OSError, ValueError):
+            report = {}
+        report[self.name] = {
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "wall": round(sum(stage["wall"] for stage in self.stages), 4),
+            "cpu": round(sum(stage["cpu"] for stage in self.stages), 4),
+            "stages": self.stages,
+        }
+        directory = os.path.dirname(self.report_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.report_file, "w") as report_file:
+            json.dump(report, report_file, indent=2)
@@ -1,3 +1,7 @@
+import html
+import json
+import os
+
 from docutils import nodes
 from docutils.parsers.rst import Directive, directives
 
@@ -7,6 +11,26 @@ ROOTTAGLINK = "tags/%s.html"
 SERMONTAGLINK = "../tags/%s.html"
 SERMONREFERENTLINK = "../predikanten/%s.html"
 SERMONCHURHLINK = "../kerken/%s.html"
+# Written by rvo.weblog into source/weblog/.
+NAVIGATION_FILE = os.path.join("weblog", "navigation.json")
+# Json file in the source dir with the original dimensions of our photos:
+# {"photo id": {"width": 3000, "height": 2000, "sizes": ["S", "M", "L"]}}.
+# "sizes" is optional, without it we assume every size exists.
+SMUGMUG_MANIFEST = "smugmug-manifest.json"
+# SmugMug size suffixes with their bounding boxes, smallest first.
+SMUGMUG_SIZES = {
+    "S": (400, 300),
+    "M": (600, 450),
+    "L": (800, 600),
+    "XL": (1024, 768),
+    "X2": (1280, 960),
+    "X3": (1600, 1200),
+}
+# The first images of a page are "above the fold", the rest loads lazily.
+EAGER_IMAGES = 1
+
+# Photo id -> dimensions, filled by read_smugmug_manifest().
+smugmug_manifest = {}
 
 
 def align(argument):
@@ -42,6 +66,24 @@ class RootTagLinks(TagLinks):
     taglink = ROOTTAGLINK
 
 
+def read_smugmug_manifest(filename):
+    """Load the photo dimensions. Without manifest we just don't have them."""
+    try:
+        with open(filename) as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        manifest = {}
+    smugmug_manifest.clear()
+    smugmug_manifest.update(manifest)
+
+
+def scaled_size(width, height, suffix):
+    """Return the dimensions of a photo at the SmugMug size"""
+    box_width, box_height = SMUGMUG_SIZES[suffix]
+    factor = min(box_width / width, box_height / height, 1)
+    return round(width * factor), round(height * factor)
+
+
 class SmugmugImage(Directive):
     required_arguments = 1
     optional_arguments = 0
@@ -78,12 +120,68 @@ class SmugmugImage(Directive):
                 photo_id = reference.split("/")[-1]
             image_url = f"{SMUGMUG}/photos/{photo_id}-M.jpg"
 
+        env = getattr(self.state.document.settings, "env", None)
+        if env is not None:
+            manifest = os.path.join(env.srcdir, env.config.smugmug_manifest)
+            # Sphinx re-reads pages with a missing dependency every time.
+            if os.path.exists(manifest):
+                env.note_dependency(manifest)
+        dimensions = smugmug_manifest.get(photo_id)
+        if dimensions:
+            html_code = self.responsive_html(photo_id, dimensions, lightbox)
+            return [nodes.raw("", html_code, format="html")]
         self.options["uri"] = image_url
         image_node = nodes.image(rawsource=self.block_text, **self.options)
         reference_node = nodes.reference(refuri=lightbox)
         reference_node += image_node
         return [reference_node]
 
+    def responsive_html(self, photo_id, dimensions, lightbox):
+        """Return link+img with dimensions, srcset and (maybe) lazy loading"""
+        original = dimensions["width"], dimensions["height"]
+        available = dimensions.get("sizes") or list(SMUGMUG_SIZES)
+        srcset = {}
+        for suffix in SMUGMUG_SIZES:
+            if suffix not in available:
+                continue
+            width, _height = scaled_size(*original, suffix)
+            # Small originals have the same width in several sizes.
+            srcset.setdefault(width, f"{SMUGMUG}/photos/{photo_id}-{suffix}.jpg")
+        width, height = scaled_size(*original, "M")
+        if "scale" in self.options:
+            width = round(width * self.options["scale"] / 100)
+            height = round(height * self.options["scale"] / 100)
+        # Only one of width/height given? Then keep the aspect ratio.
+        ratio = original[1] / original[0]
+        if "width" in self.options:
+            width = self.options["width"]
+            if "height" not in self.options:
+                height = round(width * ratio)
+        if "height" in self.options:
+            height = self.options["height"]
+            if "width" not in self.options:
+                width = round(height / ratio)
+        image_url = f"{SMUGMUG}/photos/{photo_id}-M.jpg"
+        attributes = {
+            "src": image_url,
+            "srcset": ", ".join(f"{url} {size}w" for size, url in srcset.items()),
+            "sizes": f"(max-width: {width}px) 100vw, {width}px",
+            "width": width,
+            "height": height,
+            "alt": self.options.get("alt", image_url),
+        }
+        if "align" in self.options:
+            attributes["class"] = f"align-{self.options['align']}"
+        document = self.state.document
+        document.smugmug_images = getattr(document, "smugmug_images", 0) + 1
+        if document.smugmug_images > EAGER_IMAGES:
+            attributes["loading"] = "lazy"
+        img = " ".join(
+            f'{name}="{html.escape(str(value))}"' for name, value in attributes.items()
+        )
+        link = html.escape(lightbox)
+        return f'<a class="reference external" href="{link}"><img {img} /></a>'
+
 
 class SermonInfo(Directive):
     required_arguments = 0
@@ -175,18 +273,131 @@ def inside_weblog(app, pagename, templatename, context, doctree):
     context["inside_weblog"] = _is_inside_weblog(pagename)
 
 
+def load_smugmug_manifest(app):
+    """Load the photo dimensions for the smugmug directive
+
+    It is registered for the ``builder-inited`` event, so before sphinx
+    starts its parallel processes.
+
+    """
+    read_smugmug_manifest(os.path.join(app.srcdir, app.config.smugmug_manifest))
+
+
+def load_navigation(app):
+    """Load previous/next entry info generated by create-weblog-pages
+
+    It is registered for the ``builder-inited`` event.
+
+    """
+    filename = os.path.join(app.srcdir, NAVIGATION_FILE)
+    try:
+        with open(filename) as navigation_file:
+            app.weblog_navigation = json.load(navigation_file)
+    except (OSError, ValueError):
+        app.weblog_navigation = {}
+
+
+def outdated_navigation(app, env):
+    """Return the entries whose previous/next links changed
+
+    It is registered for the ``env-get-updated`` event. Sphinx only writes
+    pages it re-read, so a new entry would otherwise never show up as
+    "next" on the previously newest one and a removed entry would stay
+    linked from its neighbours. The links a page was written with are kept
+    in the environment.
+
+    """
+    written = getattr(env, "rvo_weblog_navigation", {})
+    navigation = {
+        docname: links
+        for docname, links in getattr(app, "weblog_navigation", {}).items()
+        if docname in env.all_docs
+    }
+    env.rvo_weblog_navigation = navigation
+    return [
+        docname for docname in navigation if navigation[docname] != written.get(docname)
+    ]
+
+
+def purge_navigation(app, env, docname):
+    """Forget the links of a removed or re-read page
+
+    It is registered for the ``env-purge-doc`` event.
+
+    """
+    getattr(env, "rvo_weblog_navigation", {}).pop(docname, None)
+
+
+def merge_navigation(app, env, docnames, other):
+    """Merge the links of pages read by a parallel worker
+
+    It is registered for the ``env-merge-info`` event.
+
+    """
+    written = getattr(other, "rvo_weblog_navigation", {})
+    merged = getattr(env, "rvo_weblog_navigation", {})
+    merged.update(
+        (docname, written[docname]) for docname in docnames if docname in written
+    )
+    env.rvo_weblog_navigation = merged
+
+
+def entry_navigation(app, pagename, templatename, context, doctree):
+    """Inject links to the previous/next weblog entry into the context
+
+    It is registered for the ``html-page-context`` event.
+
+    """
+    navigation = getattr(app, "weblog_navigation", {}).get(pagename)
+    if not navigation:
+        return
+    pathto = context["pathto"]
+    for direction in ["prev", "next"]:
+        target = navigation[direction]
+        if target is None:
+            context[f"weblog_{direction}"] = None
+            continue
+        context[f"weblog_{direction}"] = {
+            "title": target["title"],
+            "url": pathto(target["docname"]),
+        }
+
+
 def setup(app):
-    """Setup for sphinx"""
-    app.add_directive("smugmug", SmugmugImage)
-    app.add_directive("tags", TagLinks)
-    app.add_directive("roottags", RootTagLinks)
+    """Setup for sphinx
+
+    Safe for parallel reading and writing: the directives only return
+    nodes and the event handlers only fill the page context. The
+    navigation and the smugmug manifest are loaded once, before sphinx
+    forks its workers. The only thing we store in the build environment
+    are the previous/next links the entries were written with, those are
+    purged and merged like sphinx' own data.
 
-    app.add_directive("preek", SermonInfo)
+    """
+    # Override, as "rvo build" already registered them for plain docutils.
+    app.add_directive("smugmug", SmugmugImage, override=True)
+    app.add_directive("tags", TagLinks, override=True)
+    app.add_directive("roottags", RootTagLinks, override=True)
+
+    app.add_directive("preek", SermonInfo, override=True)
+    app.add_config_value("smugmug_manifest", SMUGMUG_MANIFEST, "env")
+    app.connect("builder-inited", load_smugmug_manifest)
     app.connect("html-page-context", breadcrumbs)
     app.connect("html-page-context", inside_weblog)
+    app.connect("builder-inited", load_navigation)
+    app.connect("env-get-updated", outdated_navigation)
+    app.connect("env-purge-doc", purge_navigation)
+    app.connect("env-merge-info", merge_navigation)
+    app.connect("html-page-context", entry_navigation)
+    return {
+        "version": "0.1.0",
+        "parallel_read_safe": True,
+        "parallel_write_safe": True,
+    }
 
 
-def setup_for_plain_docutils():
+def setup_for_plain_docutils(manifest=os.path.join("source", SMUGMUG_MANIFEST)):
+    read_smugmug_manifest(manifest)
     directives.register_directive("smugmug", SmugmugImage)
     directives.register_directive("tags", TagLinks)
     directives.register_directive("roottags", RootTagLinks)
@@ -1,5 +1,6 @@
 """Script to create my /preken overview"""
 
+import argparse
 import collections
 import datetime
 import logging
@@ -8,12 +9,16 @@ import sys
 import time
 from functools import total_ordering
 
-from rvo.rst import setup_for_plain_docutils
-from rvo.weblog import conditional_write, utf8_open
+from rvo.cache import JsonCache, MetadataCache, cache_file
+from rvo.instrument import Instrumentation
+from rvo.utils import save_manifest, write_if_changed
+from rvo.weblog import utf8_open
 
 logger = logging.getLogger(__name__)
 
 BASE_URL = "http://reinout.vanrees.org/preken"
+# Info types that get their own overview pages.
+OVERVIEW_TYPES = ["kerk", "predikant", "tags"]
 INFO_TYPES = {
     "kerk": "Kerken",
     "predikant": "Predikanten",
@@ -24,6 +29,27 @@ INFO_TYPES = {
 }
 
 
+def parse_fields(lines):
+    """Return title and ``:field:`` values of a sermon in one pass
+
+    Fields not found in the lines are an empty list. If a field occurs more
+    than once, the last one wins.
+
+    """
+    result = {info_type: [] for info_type in INFO_TYPES}
+    result["title"] = lines[0].strip()
+    for line in lines:
+        stripped = line.strip()
+        if not stripped.startswith(":"):
+            continue
+        info_type, _colon, info = stripped[1:].partition(":")
+        if info_type not in INFO_TYPES:
+            continue
+        separator = ";" if info_type == "tekst" else ","
+        result[info_type] = [info_item.strip() for info_item in info.split(separator)]
+    return result
+
+
 def sorted_by_size(dictionary):
     """Return dictionary keys, sorted by biggest key."""
     keys_and_size = [(key, len(dictionary[key])) for key in dictionary]
@@ -35,8 +61,14 @@ def sorted_by_size(dictionary):
 class Sermonlog:
     """Wrapper around sermon directory."""
 
-    def __init__(self, sermonlogdir):
+    def __init__(self, sermonlogdir, cache_dir=".", incremental=False):
         self.sermonlogdir = sermonlogdir
+        self.cache = MetadataCache(cache_file("sermons.json", cache_dir))
+        # Incremental: only regenerate pages whose sermons changed.
+        self.incremental = incremental
+        self.membership = JsonCache(cache_file("sermon-membership.json", cache_dir))
+        self.dirty = None
+        self.skipped = 0
         self.years = collections.defaultdict(list)
         self.kerk = collections.defaultdict(list)
         self.predikant = collections.defaultdict(list)
@@ -55,6 +87,69 @@ class Sermonlog:
                 # Not a real 4-digit thingy.
                 continue
             self._collect_sermons(year)
+        self.cache.prune()
+        self.cache.save()
+        logger.info(self.cache.report())
+        if self.incremental:
+            self.dirty = self.dirty_pages()
+
+    def current_membership(self):
+        result = {}
+        for sermons in self.years.values():
+            for sermon in sermons:
+                info = {"year": sermon.year, "title": sermon.title}
+                info["datum"] = sermon.datum
+                for info_type in OVERVIEW_TYPES:
+                    info[info_type] = getattr(sermon, info_type)
+                result[sermon.filename] = info
+        return result
+
+    def dirty_pages(self):
+        """Return filenames of year/overview pages whose sermons changed
+
+        A sermon that is added, removed or changed (title, date, kerk, etc.)
+        dirties its year page and its old and new overview pages.
+
+        """
+        previous = self.membership.data
+        current = self.current_membership()
+        dirty = set()
+        for filename in previous.keys() | current.keys():
+            old = previous.get(filename)
+            new = current.get(filename)
+            if old == new:
+                continue
+            for info in [old, new]:
+                if info is None:
+                    continue
+                dirty.add(self.year_filename(info["year"]))
+                for info_type in OVERVIEW_TYPES:
+                    for info_item in info[info_type]:
+                        dirty.add(self.overview_filename(info_type, info_item))
+        return dirty
+
+    def save_membership(self):
+        """Remember which sermons (with which info) we generated pages for"""
+        current = self.current_membership()
+        if current != self.membership.data:
+            self.membership.data = current
+            self.membership.changed = True
+        self.membership.save()
+
+    def needs_writing(self, filename):
+        """Return whether we have to (re)generate the file"""
+        if self.dirty is None or filename in self.dirty or not os.path.exists(filename):
+            return True
+        self.skipped += 1
+        return False
+
+    def year_filename(self, year):
+        return os.path.join(self.sermonlogdir, str(year), "index.txt")
+
+    def overview_filename(self, info_type, info_item):
+        return os.path.join(
+            self.sermonlogdir, INFO_TYPES[info_type].lower(), info_item + ".txt"
+        )
 
     def _collect_sermons(self, year):
         """Collect sermons for one year directory."""
@@ -64,19 +159,74 @@ class Sermonlog:
                 continue
             if sermon_file == "index.txt":
                 continue
-            sermon = Sermon(year, year_dir, sermon_file)
-            self.years[sermon.year].append(sermon)
-            for info_type in INFO_TYPES:
-                if info_type in ["datum", "toegevoegd"]:
+            self._add_sermon(Sermon(year, year_dir, sermon_file, cache=self.cache))
+
+    def _add_sermon(self, sermon):
+        self.years[sermon.year].append(sermon)
+        for info_type in INFO_TYPES:
+            if info_type in ["datum", "toegevoegd"]:
+                continue
+            for tag in getattr(sermon, info_type, None):
+                if tag is None:
                     continue
-                for tag in getattr(sermon, info_type, None):
-                    if tag is None:
-                        continue
-                    getattr(self, info_type)[tag].append(sermon)
+                getattr(self, info_type)[tag].append(sermon)
+
+    def _remove_sermon(self, filename):
+        """Remove the sermon from the year and tag lists, if we have it
+
+        Sermons compare on date, so we filter on identity instead of using
+        ``list.remove()``.
+
+        """
+        for year, sermons in self.years.items():
+            found = [sermon for sermon in sermons if sermon.filename == filename]
+            if found:
+                break
+        else:
+            return
+        old = found[0]
+        collections_and_keys = [(self.years, year)]
+        for info_type in INFO_TYPES:
+            if info_type in ["datum", "toegevoegd"]:
+                continue
+            for tag in getattr(old, info_type):
+                collections_and_keys.append((getattr(self, info_type), tag))
+        for collection, key in collections_and_keys:
+            if key not in collection:
+                # Tag mentioned twice in the same sermon.
+                continue
+            collection[key] = [
+                sermon for sermon in collection[key] if sermon is not old
+            ]
+            if not collection[key]:
+                del collection[key]
+
+    def update_sermons(self, paths):
+        """Re-read added, changed and removed sermons and update their pages
+
+        Only the year and overview pages of the changed sermons are written
+        again, we don't read the other sermons.
+
+        """
+        for path in paths:
+            self._remove_sermon(path)
+            if not os.path.exists(path):
+                continue
+            year_dir, sermon_file = os.path.split(path)
+            year = int(os.path.basename(year_dir))
+            self._add_sermon(Sermon(year, year_dir, sermon_file, cache=self.cache))
+        self.cache.save()
+        self.dirty = self.dirty_pages()
+        self.write_years()
+        self.write_index()
+        self.write_overviews()
+        self.save_membership()
 
     def write_years(self):
         for year in self.years:
-            year_index = os.path.join(self.sermonlogdir, str(year), "index.txt")
+            year_index = self.year_filename(year)
+            if not self.needs_writing(year_index):
+                continue
             content = []
             content.append(str(year))
             content.append("#" * len(str(year)))
@@ -88,7 +238,7 @@ class Sermonlog:
             sermons.sort()
             for sermon in sermons:
                 content.append("    " + sermon.year_link)
-            conditional_write(year_index, "\n".join(content))
+            write_if_changed(year_index, "\n".join(content))
 
     def write_index(self):
         total_index = os.path.join(self.sermonlogdir, "index.txt")
@@ -132,7 +282,7 @@ class Sermonlog:
                     f"    {info_item} ({len(info_items[info_item])}) <{dirname}/{info_item}.txt>"
                 )
             content.append("")
-        conditional_write(total_index, "\n".join(content))
+        write_if_changed(total_index, "\n".join(content))
 
     def recent_ten(self):
         """Return ten most recent sermons."""
@@ -145,11 +295,12 @@ class Sermonlog:
         return most_recent
 
     def write_overviews(self):
-        for info_type in INFO_TYPES:
-            if info_type in ["datum", "toegevoegd", "tekst"]:
-                continue
+        for info_type in OVERVIEW_TYPES:
             info_items = getattr(self, info_type)
             for info_item in info_items:
+                filename = self.overview_filename(info_type, info_item)
+                if not self.needs_writing(filename):
+                    continue
                 content = []
                 title = info_item
                 content.append(title)
@@ -163,26 +314,31 @@ class Sermonlog:
                 for sermon in sermons:
                     content.append(f"    {sermon.tag_link}")
                 content.append("")
-                filename = os.path.join(
-                    self.sermonlogdir, INFO_TYPES[info_type].lower(), info_item + ".txt"
-                )
-                conditional_write(filename, "\n".join(content))
+                write_if_changed(filename, "\n".join(content))
 
 
 @total_ordering
 class Sermon:
     """Extracted info from one sermon *.txt file."""
 
-    def __init__(self, year, directory, filename):
+    def __init__(self, year, directory, filename, cache=None):
         self.year = year
         self.name = filename[:-4]
         self.filename = os.path.join(directory, filename)
-        self.lines = utf8_open(self.filename).read().split("\n")
-        self.title = self.lines[0].strip()
+        stat = os.stat(self.filename)
+        metadata = cache.lookup(self.filename, stat) if cache else None
+        if metadata is None:
+            self.lines = utf8_open(self.filename).read().split("\n")
+            metadata = parse_fields(self.lines)
+            if not metadata["toegevoegd"]:
+                self.add_date_added()
+            if cache:
+                cache.store(self.filename, stat, metadata)
+        self.title = metadata["title"]
         # Modification time
-        self.last_modified = time.gmtime(os.path.getmtime(self.filename))
+        self.last_modified = time.gmtime(stat.st_mtime)
         self.last_modified = time.strftime("%Y-%m-%dT%H:%M", self.last_modified)
-        self.extract_info()
+        self.extract_info(metadata)
 
     def __lt__(self, other):
         return self.datum < other.datum
@@ -190,22 +346,9 @@ class Sermon:
     def __eq__(self, other):
         return self.datum == other.datum
 
-    def extract_info(self):
+    def extract_info(self, metadata):
         for info_type in INFO_TYPES:
-            setattr(self, info_type, [])
-            tagname = f":{info_type}:"
-            for line in self.lines:
-                if tagname in line:
-                    info = line.replace(tagname, "")
-                    if info_type == "tekst":
-                        info_items = info.split(";")
-                    else:
-                        info_items = info.split(",")
-                    info_items = [info_item.strip() for info_item in info_items]
-                    setattr(self, info_type, info_items)
-                    continue
-        if not self.toegevoegd:
-            self.add_date_added()
+            setattr(self, info_type, metadata[info_type])
         # For the dates, we don't want lists.
         self.datum = self.datum[0]
         self.toegevoegd = self.toegevoegd[0]
@@ -252,13 +395,35 @@ class Sermon:
 
 def main():
     logging.basicConfig(level=logging.DEBUG)
-    if len(sys.argv) < 2:
-        print("Missing start dir of weblog")
-        sys.exit(1)
-    sermonlogdir = sys.argv[1]
-    setup_for_plain_docutils()
-    sermonlog = Sermonlog(sermonlogdir)
-    sermonlog.collect_entries()
-    sermonlog.write_years()
-    sermonlog.write_index()
-    sermonlog.write_overviews()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("sermonlogdir", help="start dir of the sermons")
+    parser.add_argument(
+        "--clear-cache",
+        action="store_true",
+        help="forget the cached sermon info and read every sermon again",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only regenerate year/overview pages whose sermons changed",
+    )
+    options = parser.parse_args()
+    sermonlogdir = options.sermonlogdir
+    sermonlog = Sermonlog(sermonlogdir, incremental=options.incremental)
+    if options.clear_cache:
+        sermonlog.cache.invalidate()
+        sermonlog.membership.invalidate()
+    instrumentation = Instrumentation("sermonlog")
+    with instrumentation.stage("collect_entries"):
+        sermonlog.collect_entries()
+    with instrumentation.stage("write_years"):
+        sermonlog.write_years()
+    with instrumentation.stage("write_index"):
+        sermonlog.write_index()
+    with instrumentation.stage("write_overviews"):
+        sermonlog.write_overviews()
+    sermonlog.save_membership()
+    if options.incremental:
+        logger.info("Skipped %s unchanged year/overview pages", sermonlog.skipped)
+    logger.info(save_manifest())
+    instrumentation.save()
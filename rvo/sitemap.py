@@ -1,20 +1,72 @@
+import argparse
+import glob
+import gzip
+import itertools
 import os
 import time
 
-from jinja2 import Environment, PackageLoader
+from rvo.cache import MetadataCache, cache_file, file_hash
+from rvo.compress import COMPRESSED_SUFFIXES
+from rvo.instrument import Instrumentation
+from rvo.templating import get_template
 
-jinja_env = Environment(loader=PackageLoader("rvo", "templates"))
+HTML_DIR = "build/html"
+BASE_URL = "http://reinout.vanrees.org"
+# Sitemap protocol limits per sitemap file.
+MAX_URLS = 50000
+MAX_BYTES = 50 * 1024 * 1024
+# Room for one more <url> element, so that we stop before MAX_BYTES.
+URL_MARGIN = 2048
+SKIPPED_DIRS = ["_sources", "_static", ".svn"]
+SKIPPED_FILES = [
+    "favicon.ico",
+    "genindex.html",
+    "objects.inv",
+    "search.html",
+    ".buildinfo",
+    ".DS_Store",
+    "searchindex.js",
+]
+
+
+class LastmodCache(MetadataCache):
+    """Last real modification date per file, based on a hash of the content
+
+    Sphinx and rsync touch files without changing them. Only when the
+    content hash changes do we use the file's mtime as new last modified
+    date. Files with unchanged size and mtime aren't even hashed.
+
+    """
+
+    def last_modified(self, path, stat):
+        metadata = self.lookup(path, stat)
+        if metadata is not None:
+            return metadata["lastmod"]
+        previous = self.previous(path)
+        content_hash = file_hash(path)
+        if previous and previous["hash"] == content_hash:
+            # Touched, but not changed.
+            lastmod = previous["lastmod"]
+        else:
+            lastmod = time.strftime("%Y-%m-%d", time.gmtime(stat.st_mtime))
+        self.store(path, stat, {"hash": content_hash, "lastmod": lastmod})
+        return lastmod
 
 
 class FileInfo:
     """Wrapper around filesystem file: collects info"""
 
-    def __init__(self, dirpath, filename):
+    def __init__(self, dirpath, filename, stat=None, lastmod_cache=None):
         fullpath = os.path.join(dirpath, filename)
         self.path = dirpath.replace("build/html", "")
         self.path = self.path + "/" + filename
-        self.last_modified = time.gmtime(os.path.getmtime(fullpath))
-        self.last_modified = time.strftime("%Y-%m-%d", self.last_modified)
+        if stat is None:
+            stat = os.stat(fullpath)
+        if lastmod_cache is None:
+            self.last_modified = time.gmtime(stat.st_mtime)
+            self.last_modified = time.strftime("%Y-%m-%d", self.last_modified)
+        else:
+            self.last_modified = lastmod_cache.last_modified(fullpath, stat)
 
     @property
     def priority(self):
@@ -39,30 +91,126 @@ class FileInfo:
         return "monthly"
 
 
-def files():
-    for dirpath, _dirnames, filenames in os.walk("build/html"):
-        if "_sources" in dirpath:
-            continue
-        if "_static" in dirpath:
-            continue
-        if ".svn" in dirpath:
-            continue
-        for filename in filenames:
-            if filename in [
-                "favicon.ico",
-                "genindex.html",
-                "objects.inv",
-                "search.html",
-                ".buildinfo",
-                ".DS_Store",
-                "searchindex.js",
-            ]:
+def is_sitemap(filename):
+    return filename.startswith("sitemap") and (
+        filename.endswith(".xml") or filename.endswith(".xml.gz")
+    )
+
+
+def files(dirpath=HTML_DIR, lastmod_cache=None):
+    """Yield info on the html files, skipping sphinx' internal directories
+
+    Skipped directories aren't even entered. Our own sitemaps and the
+    precompressed .gz/.br copies are skipped, too.
+
+    """
+    subdirs = []
+    with os.scandir(dirpath) as scanned:
+        for item in scanned:
+            if item.is_dir():
+                if item.name not in SKIPPED_DIRS:
+                    subdirs.append(item.path)
+                continue
+            if item.name in SKIPPED_FILES or is_sitemap(item.name):
                 continue
-            yield FileInfo(dirpath, filename)
+            if item.name.endswith(COMPRESSED_SUFFIXES):
+                # Precompressed copies written by create-compressed.
+                continue
+            yield FileInfo(
+                dirpath, item.name, stat=item.stat(), lastmod_cache=lastmod_cache
+            )
+    for subdir in subdirs:
+        yield from files(subdir, lastmod_cache=lastmod_cache)
+
+
+def write_sitemap(template, filename, files, compress, max_urls, max_bytes):
+    """Stream files into one sitemap until it is full or files runs out"""
+    written = 0
+
+    def limited_files():
+        for count, file in enumerate(files, start=1):
+            yield file
+            if count >= max_urls or written + URL_MARGIN > max_bytes:
+                return
+
+    opener = gzip.open if compress else open
+    with opener(filename, "wb") as outfile:
+        for chunk in template.generate(files=limited_files()):
+            chunk = chunk.encode("utf-8")
+            outfile.write(chunk)
+            written += len(chunk)
+
+
+def write_sitemaps(
+    files,
+    outdir=HTML_DIR,
+    compress=False,
+    max_urls=MAX_URLS,
+    max_bytes=MAX_BYTES,
+):
+    """Write sitemap.xml, split into a sitemap index plus sitemaps if needed
+
+    Without compression and with everything fitting into one file, we get a
+    plain ``sitemap.xml``. Otherwise ``sitemap.xml`` is an index pointing at
+    ``sitemap-1.xml`` (or ``sitemap-1.xml.gz``) and so on.
+
+    """
+    sitemap_templ = get_template("sitemap.xml")
+    suffix = ".xml.gz" if compress else ".xml"
+    remaining = iter(files)
+    children = []
+    while True:
+        filename = os.path.join(outdir, f"sitemap-{len(children) + 1}{suffix}")
+        write_sitemap(sitemap_templ, filename, remaining, compress, max_urls, max_bytes)
+        children.append(filename)
+        try:
+            first = next(remaining)
+        except StopIteration:
+            break
+        remaining = itertools.chain([first], remaining)
+
+    if len(children) == 1 and not compress:
+        os.replace(children[0], os.path.join(outdir, "sitemap.xml"))
+        children = []
+    else:
+        index_templ = get_template("sitemapindex.xml")
+        with open(os.path.join(outdir, "sitemap.xml"), "w") as outfile:
+            for chunk in index_templ.generate(
+                base_url=BASE_URL,
+                sitemaps=[os.path.basename(child) for child in children],
+                last_modified=time.strftime("%Y-%m-%d", time.gmtime()),
+            ):
+                outfile.write(chunk)
+    # Remove sitemaps left over from a previous, bigger, run.
+    for old in glob.glob(os.path.join(outdir, "sitemap-*.xml*")):
+        if old not in children:
+            os.remove(old)
+    return children
 
 
 def main():
-    outfile = open("build/html/sitemap.xml", "w")
-    sitemap_templ = jinja_env.get_template("sitemap.xml")
-    outfile.write(sitemap_templ.render(files=files()))
-    outfile.close()
+    parser = argparse.ArgumentParser(description="Write build/html/sitemap.xml")
+    parser.add_argument(
+        "--compress",
+        action="store_true",
+        help="write gzipped sitemaps, with sitemap.xml as index",
+    )
+    parser.add_argument(
+        "--max-urls",
+        type=int,
+        default=MAX_URLS,
+        help="maximum number of urls per sitemap (default: %(default)s)",
+    )
+    options = parser.parse_args()
+    lastmod_cache = LastmodCache(cache_file("sitemap-lastmod.json"))
+    instrumentation = Instrumentation("sitemap")
+    with instrumentation.stage("write"):
+        write_sitemaps(
+            files(lastmod_cache=lastmod_cache),
+            compress=options.compress,
+            max_urls=options.max_urls,
+        )
+    lastmod_cache.prune()
+    lastmod_cache.save()
+    print(lastmod_cache.report())
+    instrumentation.save()
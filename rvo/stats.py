@@ -0,0 +1,170 @@
+"""Weblog statistics: posts per year/month/day, rendered as inline svg"""
+
+import datetime
+import html
+import itertools
+
+MONTH = "month"
+DAY = "day"
+# Weight of the newest number in the exponential moving average.
+RATIO = 0.2
+
+
+def parse_ymd(ymd):
+    """Return (year, month, day) ints from a yyyy-mm-dd(ish) string"""
+    year, month, day = ymd.split("-")
+    return int(year), int(month), int(day)
+
+
+def period_counts(ymds, granularity=MONTH):
+    """Return period labels and a dense list of counts per period
+
+    The periods run from january of the first year up to december of the
+    last year (or from the first to the last day). Empty periods are zero.
+    We only loop once over the dates.
+
+    """
+    dates = [parse_ymd(ymd) for ymd in ymds]
+    if not dates:
+        return [], []
+    first_year = min(date[0] for date in dates)
+    last_year = max(date[0] for date in dates)
+    if granularity == MONTH:
+        labels = [
+            (year, month)
+            for year in range(first_year, last_year + 1)
+            for month in range(1, 13)
+        ]
+        counts = [0] * len(labels)
+        for year, month, _day in dates:
+            counts[(year - first_year) * 12 + month - 1] += 1
+        return labels, counts
+    first = datetime.date(first_year, 1, 1).toordinal()
+    last = datetime.date(last_year, 12, 31).toordinal()
+    labels = [datetime.date.fromordinal(day) for day in range(first, last + 1)]
+    counts = [0] * len(labels)
+    for year, month, day in dates:
+        counts[datetime.date(year, month, day).toordinal() - first] += 1
+    return labels, counts
+
+
+def moving_average(counts, ratio=RATIO):
+    """Return exponential moving average, starting at the first count"""
+    if not counts:
+        return []
+    averages = itertools.accumulate(
+        counts,
+        lambda average, amount: (average + ratio * amount) / (1.0 + ratio),
+        initial=float(counts[0]),
+    )
+    # Drop the initial value.
+    return list(averages)[1:]
+
+
+def year_counts(labels, counts):
+    """Return (year, count) tuples from the monthly counts"""
+    result = {}
+    for (year, _month), count in zip(labels, counts):
+        result[year] = result.get(year, 0) + count
+    return list(result.items())
+
+
+def bar_chart(labels, values, width=700, height=200, color="#4444FF"):
+    """Return svg bar chart with a label below every bar"""
+    left, bottom, top = 30, 20, 10
+    plot_width = width - left
+    plot_height = height - bottom - top
+    maximum = max(values, default=0) or 1
+    bar_width = plot_width / max(len(values), 1)
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" '
+        f'height="{height}" viewBox="0 0 {width} {height}" role="img">',
+        f'<text x="{left - 4}" y="{top + 4}" text-anchor="end" '
+        f'font-size="10">{maximum}</text>',
+        f'<text x="{left - 4}" y="{top + plot_height}" text-anchor="end" '
+        'font-size="10">0</text>',
+    ]
+    for index, (label, value) in enumerate(zip(labels, values)):
+        bar_height = plot_height * value / maximum
+        x = left + index * bar_width
+        y = top + plot_height - bar_height
+        label = html.escape(str(label))
+        parts.append(
+            f'<rect x="{x + 1:.1f}" y="{y:.1f}" width="{bar_width - 2:.1f}" '
+            f'height="{bar_height:.1f}" fill="{color}">'
+            f"<title>{label}: {value}</title></rect>"
+        )
+        parts.append(
+            f'<text x="{x + bar_width / 2:.1f}" y="{height - 5}" '
+            f'text-anchor="middle" font-size="10">{label}</text>'
+        )
+    parts.append("</svg>")
+    return "\n".join(parts)
+
+
+def line_chart(series, ticks, width=700, height=300):
+    """Return svg line chart
+
+    ``series`` is a list of (legend, values, color, stroke width) tuples,
+    ``ticks`` a list of (index, label) tuples for the x axis.
+
+    """
+    left, right, bottom, top = 30, 20, 35, 25
+    plot_width = width - left - right
+    plot_height = height - bottom - top
+    maximum = max((max(values, default=0) for _, values, _, _ in series), default=0)
+    maximum = maximum or 1
+    length = max((len(values) for _, values, _, _ in series), default=0)
+    step = plot_width / max(length - 1, 1)
+
+    def y(value):
+        return top + plot_height - plot_height * value / maximum
+
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" '
+        f'height="{height}" viewBox="0 0 {width} {height}" role="img">',
+        f'<text x="{left - 4}" y="{top + 4}" text-anchor="end" '
+        f'font-size="10">{round(maximum)}</text>',
+        f'<text x="{left - 4}" y="{top + plot_height}" text-anchor="end" '
+        'font-size="10">0</text>',
+    ]
+    for number, (legend, values, color, stroke_width) in enumerate(series):
+        points = " ".join(
+            f"{left + index * step:.1f},{y(value):.1f}"
+            for index, value in enumerate(values)
+        )
+        parts.append(
+            f'<polyline points="{points}" fill="none" stroke="{color}" '
+            f'stroke-width="{stroke_width}" />'
+        )
+        legend_x = left + number * 160
+        parts.append(
+            f'<rect x="{legend_x}" y="5" width="12" height="12" fill="{color}" />'
+        )
+        parts.append(
+            f'<text x="{legend_x + 16}" y="15" font-size="11">'
+            f"{html.escape(legend)}</text>"
+        )
+    for index, label in ticks:
+        parts.append(
+            f'<text x="{left + index * step:.1f}" y="{height - 8}" '
+            f'text-anchor="middle" font-size="10">{html.escape(label)}</text>'
+        )
+    parts.append("</svg>")
+    return "\n".join(parts)
+
+
+def ticks(labels, number=5):
+    """Return ``number`` evenly spaced (index, label) tuples"""
+    if not labels:
+        return []
+    in_between = (len(labels) - 1) / max(number - 1, 1)
+    indexes = sorted({round(i * in_between) for i in range(number)})
+    return [(index, label_text(labels[index])) for index in indexes]
+
+
+def label_text(label):
+    if isinstance(label, datetime.date):
+        return label.isoformat()
+    year, month = label
+    return f"{month} {year}"
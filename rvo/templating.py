@@ -0,0 +1,30 @@
+"""The jinja environment for our templates, created on first use
+
+All scripts share one environment. Compiled templates are stored in
+build/cache/jinja/, so they're reused by the next run and by the other
+scripts. Jinja recompiles a template when its source changes.
+
+"""
+
+import functools
+import os
+
+from rvo.cache import cache_file
+
+
+@functools.cache
+def get_environment(cache_dir=None):
+    # Imported here, so that importing our modules stays cheap.
+    from jinja2 import Environment, FileSystemBytecodeCache, PackageLoader
+
+    cache_dir = os.path.abspath(cache_dir or cache_file("jinja"))
+    os.makedirs(cache_dir, exist_ok=True)
+    return Environment(
+        loader=PackageLoader("rvo", "templates"),
+        bytecode_cache=FileSystemBytecodeCache(cache_dir),
+    )
+
+
+def get_template(name):
+    """Return (compiled) template from rvo/templates/"""
+    return get_environment().get_template(name)
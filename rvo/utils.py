@@ -1,10 +1,73 @@
+import hashlib
 import logging
+import os
+import threading
 from pathlib import Path
 
+from rvo.cache import JsonCache, cache_file
+
 logger = logging.getLogger(__name__)
 
 
-def write_if_changed(target: Path, desired_content: str) -> bool:
+class WriteManifest(JsonCache):
+    """Content hashes of the files we wrote, keyed on absolute path
+
+    We also store the size and mtime of the file after writing. If those
+    still match, the file on disk is still what we wrote and comparing the
+    hashes is enough: no need to read the old file back.
+
+    """
+
+    def __init__(self, filename):
+        super().__init__(filename)
+        self.written = 0
+        self.skipped = 0
+        self.lock = threading.Lock()
+
+    def report(self):
+        return f"Wrote {self.written} files, skipped {self.skipped} unchanged ones"
+
+
+_manifest = None
+_files_read = 0
+_files_read_lock = threading.Lock()
+
+
+def get_manifest():
+    global _manifest
+    if _manifest is None:
+        _manifest = WriteManifest(cache_file("write-manifest.json"))
+    return _manifest
+
+
+def reset_manifest():
+    """Forget the loaded manifest, the next write loads it (again) from disk"""
+    global _manifest
+    _manifest = None
+
+
+def count_read(number=1):
+    """Register that we read a file (for instrumentation)"""
+    global _files_read
+    with _files_read_lock:
+        _files_read += number
+
+
+def file_counts():
+    """Return the number of files read, written and skipped so far"""
+    manifest = get_manifest()
+    return {
+        "read": _files_read,
+        "written": manifest.written,
+        "skipped": manifest.skipped,
+    }
+
+
+def content_hash(content: str) -> str:
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+def write_if_changed(target: Path | str, desired_content: str) -> bool:
     """Write content to file if different, not if it is the same
 
     And create the file if it doesn't exist.
@@ -12,12 +75,63 @@ def write_if_changed(target: Path, desired_content: str) -> bool:
     Return true if created.
 
     """
-    existing_content = target.read_text() if target.exists() else ""
+    target = Path(target)
+    key = os.path.abspath(target)
+    desired_hash = content_hash(desired_content)
+    manifest = get_manifest()
+    with manifest.lock:
+        recorded = manifest.data.get(key)
+    try:
+        stat = target.stat()
+    except FileNotFoundError:
+        stat = None
+
+    up_to_date = bool(
+        stat
+        and recorded
+        and recorded["size"] == stat.st_size
+        and recorded["mtime"] == stat.st_mtime_ns
+    )
+    if up_to_date:
+        # The file is still what we wrote last time.
+        same = recorded["hash"] == desired_hash
+    elif stat:
+        # Unknown or changed by someone else: compare the actual content.
+        count_read()
+        same = target.read_text(encoding="utf-8") == desired_content
+    else:
+        same = False
 
-    if desired_content == existing_content:
+    if same:
         logger.debug(f"{target} remained the same")
+        with manifest.lock:
+            manifest.skipped += 1
+            if not up_to_date:
+                manifest.data[key] = {
+                    "hash": desired_hash,
+                    "size": stat.st_size,
+                    "mtime": stat.st_mtime_ns,
+                }
+                manifest.changed = True
         return False
 
-    target.write_text(desired_content)
+    target.write_text(desired_content, encoding="utf-8")
+    stat = target.stat()
     logger.info(f"Wrote {target}")
+    with manifest.lock:
+        manifest.written += 1
+        manifest.data[key] = {
+            "hash": desired_hash,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+        }
+        manifest.changed = True
     return True
+
+
+def save_manifest():
+    """Persist the write manifest and return a written/skipped report"""
+    manifest = get_manifest()
+    with manifest.lock:
+        manifest.save()
+    return manifest.report()
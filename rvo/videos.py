@@ -6,6 +6,7 @@ from pathlib import Path
 import tomlkit
 
 from rvo import utils
+from rvo.instrument import Instrumentation
 
 logger = logging.getLogger(__name__)
 
@@ -25,9 +26,8 @@ INDEX_TEMPLATE = """\
 """
 
 
-def main():
+def write_videos():
     years = defaultdict(dict)
-    logging.basicConfig(level=logging.INFO)
     for year_dir in METADATA_DIR.glob("????"):
         year = year_dir.name
         output_dir = OUTPUT_DIR / year
@@ -35,6 +35,7 @@ def main():
             output_dir.mkdir()
         for metadata_file in year_dir.glob("*.toml"):
             id = metadata_file.stem
+            utils.count_read()
             metadata = tomlkit.loads(metadata_file.read_text())
             output_filename = id + ".md"
             years[year][id] = metadata
@@ -64,5 +65,14 @@ def main():
     utils.write_if_changed(output_file, output)
 
 
+def main():
+    logging.basicConfig(level=logging.INFO)
+    instrumentation = Instrumentation("videos")
+    with instrumentation.stage("write_videos"):
+        write_videos()
+    logger.info(utils.save_manifest())
+    instrumentation.save()
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,197 @@
+"""Keep the weblog and sermonlog pages up to date while editing
+
+Usage: ``rvo watch``, inside the ``docs/`` directory. After one normal
+(incremental) run, the weblog and sermonlog stay in memory. Every added,
+changed or removed entry is patched into them and only the pages, feeds
+and statistics that change are written again.
+
+Changes are noticed with inotify if ``inotify_simple`` is installed,
+otherwise by polling the modification times.
+
+"""
+
+import logging
+import os
+import re
+import time
+
+from rvo import utils
+from rvo.sermonlog import Sermonlog
+from rvo.weblog import Weblog
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two scans when polling.
+POLL_INTERVAL = 1.0
+# Milliseconds to wait for more events, editors often save in several steps.
+READ_DELAY = 50
+# Entry files, relative to the weblog/sermonlog dir. Generated index.txt
+# files and editor lock/backup files are excluded.
+WEBLOG_ENTRY = re.compile(r"^\d{4}/\d{2}/\d{2}/(?!index\.txt$)[^/.#][^/]*\.txt$")
+SERMON_ENTRY = re.compile(r"^\d{4}/(?!index\.txt$)[^/.#][^/]*\.txt$")
+
+
+class PollingWatcher:
+    """Report changed files by comparing their mtime and size"""
+
+    def __init__(self, directories, interval=POLL_INTERVAL):
+        self.directories = directories
+        self.interval = interval
+        # Right away, so that changes made before changes() is called count.
+        self.previous = self.snapshot()
+
+    def snapshot(self):
+        result = {}
+        for directory in self.directories:
+            for dirpath, _dirnames, filenames in os.walk(directory):
+                for filename in filenames:
+                    if not filename.endswith(".txt"):
+                        continue
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    result[path] = (stat.st_mtime_ns, stat.st_size)
+        return result
+
+    def changes(self):
+        """Yield sets of added, changed and removed files"""
+        while True:
+            time.sleep(self.interval)
+            current = self.snapshot()
+            changed = {
+                path
+                for path in self.previous.keys() | current.keys()
+                if self.previous.get(path) != current.get(path)
+            }
+            self.previous = current
+            if changed:
+                yield changed
+
+
+class InotifyWatcher:
+    """Report changed files with inotify, without scanning anything"""
+
+    def __init__(self, directories):
+        flags = inotify_simple.flags
+        self.mask = (
+            flags.CREATE
+            | flags.CLOSE_WRITE
+            | flags.MOVED_FROM
+            | flags.MOVED_TO
+            | flags.DELETE
+        )
+        self.inotify = inotify_simple.INotify()
+        # inotify isn't recursive, so we watch every directory.
+        self.directories = {}
+        for directory in directories:
+            self.watch(directory)
+
+    def watch(self, directory):
+        """Watch the directory and its subdirectories, return their files"""
+        found = set()
+        for dirpath, _dirnames, filenames in os.walk(directory):
+            self.directories[self.inotify.add_watch(dirpath, self.mask)] = dirpath
+            found.update(os.path.join(dirpath, filename) for filename in filenames)
+        return found
+
+    def changes(self):
+        """Yield sets of added, changed and removed files"""
+        flags = inotify_simple.flags
+        while True:
+            changed = set()
+            for event in self.inotify.read(read_delay=READ_DELAY):
+                directory = self.directories.get(event.wd)
+                if directory is None or not event.name:
+                    continue
+                path = os.path.join(directory, event.name)
+                if event.mask & flags.ISDIR:
+                    if event.mask & (flags.CREATE | flags.MOVED_TO):
+                        changed.update(self.watch(path))
+                    continue
+                if event.mask & flags.CREATE:
+                    # Wait for the CLOSE_WRITE.
+                    continue
+                changed.add(path)
+            if changed:
+                yield changed
+
+
+class Watch:
+    """Weblog and sermonlog in memory, updated for every changed file"""
+
+    def __init__(self, rootdir=".", poll_interval=POLL_INTERVAL):
+        self.weblog = Weblog(rootdir, incremental=True)
+        self.sermonlog = Sermonlog(
+            os.path.join(rootdir, "source", "preken"), incremental=True
+        )
+        self.poll_interval = poll_interval
+
+    def build(self):
+        """Start with a normal (incremental) run"""
+        self.weblog.assign_entries()
+        self.weblog.create_files()
+        self.weblog.create_atom()
+        self.weblog.create_for_homepage()
+        self.weblog.create_stats()
+        self.sermonlog.collect_entries()
+        self.sermonlog.write_years()
+        self.sermonlog.write_index()
+        self.sermonlog.write_overviews()
+        self.sermonlog.save_membership()
+        logger.info(utils.save_manifest())
+
+    def entries(self, paths, directory, pattern):
+        return {
+            path
+            for path in paths
+            if pattern.match(os.path.relpath(path, directory).replace(os.sep, "/"))
+        }
+
+    def handle(self, paths):
+        """Update the weblog and sermonlog for the changed files"""
+        weblog_paths = self.entries(paths, self.weblog.weblogdir, WEBLOG_ENTRY)
+        sermon_paths = self.entries(paths, self.sermonlog.sermonlogdir, SERMON_ENTRY)
+        if not weblog_paths and not sermon_paths:
+            # Probably just the pages we generated ourselves.
+            return
+        start = time.perf_counter()
+        try:
+            if weblog_paths:
+                changed_tags = self.weblog.update_entries(weblog_paths)
+                self.weblog.create_changed_files(changed_tags)
+            if sermon_paths:
+                self.sermonlog.update_sermons(sermon_paths)
+        except SystemExit:
+            # A refused new tag or a sermon that got a "toegevoegd" date.
+            logger.warning("Stopped handling %s", ", ".join(sorted(paths)))
+            return
+        logger.info(utils.save_manifest())
+        milliseconds = (time.perf_counter() - start) * 1000
+        for path in sorted(weblog_paths | sermon_paths):
+            logger.info("Updated for %s", path)
+        logger.info("Regenerated in %.0f ms", milliseconds)
+
+    def watcher(self):
+        directories = [self.weblog.weblogdir, self.sermonlog.sermonlogdir]
+        if inotify_simple is None:
+            logger.info("inotify_simple isn't installed, polling for changes")
+            return PollingWatcher(directories, interval=self.poll_interval)
+        return InotifyWatcher(directories)
+
+    def run(self):
+        # Watch before building, so that we don't miss changes in between.
+        watcher = self.watcher()
+        self.build()
+        logger.info("Watching for changes, stop with ctrl-c")
+        try:
+            for paths in watcher.changes():
+                self.handle(paths)
+        except KeyboardInterrupt:
+            pass
@@ -1,38 +1,83 @@
 """Script to create index, date and tag pages."""
 
+import argparse
+import bisect
 import codecs
 import datetime
+import itertools
+import json
+import multiprocessing
 import os
 import sys
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from functools import total_ordering
+from operator import attrgetter
 
-from docutils.core import publish_parts
-from docutils.writers.html4css1 import Writer
-from jinja2 import Environment, PackageLoader
-
-from rvo.rst import setup_for_plain_docutils
+from rvo import stats
+from rvo.cache import JsonCache, MetadataCache, RenderCache, cache_file
+from rvo.feeds import FEEDS, fill_feeds
+from rvo.instrument import Instrumentation
+from rvo.templating import get_template
+from rvo.utils import count_read, save_manifest, write_if_changed
 
 TAGSTART = ".. tags::"
 NUM_RECENT_ENTRIES = 10
-MONTH_NAMES = [str(i + 1) for i in range(12)]
-
-
-jinja_env = Environment(loader=PackageLoader("rvo", "templates"))
+# Number of threads for reading entries, mostly helps on slow/network disks.
+READ_WORKERS = 8
+# Number of processes for rendering feed html, None means "number of cpus".
+RENDER_WORKERS = None
+# Number of entries per tag page, 0 means "everything on one page".
+TAG_PAGE_SIZE = 100
+NAVIGATION_FILENAME = "navigation.json"
+# Photo dimensions used when rendering the feed html, see rvo.rst.
+SMUGMUG_MANIFEST = "smugmug-manifest.json"
 
 
 def utf8_open(filepath, mode="r"):
+    if "r" in mode:
+        count_read()
     return codecs.open(filepath, mode, "utf-8")
 
 
-def conditional_write(filename, new):
-    if os.path.exists(filename):
-        old = utf8_open(filename, "r").read()
-    else:
-        old = None
-    if new != old:
-        utf8_open(filename, "w").write(new)
-        print(".")
+def numbered_subdirs(directory):
+    """Return sorted (name, path) tuples of the yyyy/mm/dd style subdirs"""
+    with os.scandir(directory) as scanned:
+        found = [
+            (item.name, item.path)
+            for item in scanned
+            if item.name.isdigit() and item.is_dir()
+        ]
+    return sorted(found)
+
+
+def entry_files(daydir):
+    """Return sorted (path, stat) tuples of the entries in a day dir
+
+    The stat result is passed on to the entry so that we don't need to stat
+    the file a second time.
+
+    """
+    with os.scandir(daydir) as scanned:
+        found = [
+            (item.path, item.stat())
+            for item in scanned
+            if item.name.endswith(".txt") and item.name != "index.txt"
+        ]
+    return sorted(found, key=lambda path_and_stat: path_and_stat[0])
+
+
+def render_html(source):
+    """Render restructuredtext to an html snippet"""
+    # Imported here: docutils is slow to import and only needed for rendering.
+    from docutils.core import publish_parts
+    from docutils.writers.html4css1 import Writer
+
+    html_writer = Writer()
+    content = publish_parts(source, writer=html_writer)
+    html = content["html_body"]
+    html = html.replace("&nbsp;", " ")
+    return html
 
 
 def latest_update(entries):
@@ -41,10 +86,13 @@ def latest_update(entries):
 
 
 class Bucket:
-    """A bucket of entries (tag/day) or other buckets (year/month)"""
+    """A bucket of entries (tag/day) or other buckets (year/month)
+
+    Entries are appended newest first, buckets in (sorted) directory order.
+
+    """
 
     tocdepth = 1
-    sort_entries = False
 
     def __init__(self, name, directory):
         self.name = name
@@ -69,9 +117,18 @@ class Bucket:
     def filename(self):
         return os.path.join(self.dir, "index.txt")
 
-    def create_files(self):
-        """At least create ourselves. Subclasses should ensure recursion"""
-        self.create_file()
+    def create_files(self, dirty=None):
+        """At least create ourselves. Subclasses should ensure recursion
+
+        If a set of dirty filenames is passed, we only regenerate ourselves
+        if we're in there (or if our file is missing). Return the number of
+        skipped files.
+
+        """
+        if dirty is None or self.filename in dirty or not os.path.exists(self.filename):
+            self.create_file()
+            return 0
+        return 1
 
     def create_file(self):
         content = []
@@ -81,7 +138,7 @@ class Bucket:
         content += self.subitems()
         content.append("")
         content += self.overview()
-        conditional_write(self.filename, "\n".join(content))
+        write_if_changed(self.filename, "\n".join(content))
 
     def subitems(self):
         """Return link block at the start of the page"""
@@ -89,8 +146,6 @@ class Bucket:
         result.append(".. toctree::")
         result.append(f"    :maxdepth: {self.tocdepth}")
         result.append("")
-        if self.sort_entries:
-            self.items.sort()
         for item in self.items:
             link = item.filename.replace(self.dir, "")
             link = link.lstrip("/")
@@ -114,10 +169,11 @@ class Year(Bucket):
     def nice_name(self):
         return "Weblog entries for " + self.name
 
-    def create_files(self):
-        self.create_file()
+    def create_files(self, dirty=None):
+        skipped = super().create_files(dirty)
         for item in self.items:
-            item.create_files()
+            skipped += item.create_files(dirty)
+        return skipped
 
 
 class Month(Bucket):
@@ -137,17 +193,17 @@ class Month(Bucket):
         month = datetime.date(2000, int(self.name), 1).strftime("%B")
         return f"{month} {year}"
 
-    def create_files(self):
-        self.create_file()
+    def create_files(self, dirty=None):
+        skipped = super().create_files(dirty)
         for item in self.items:
-            item.create_files()
+            skipped += item.create_files(dirty)
+        return skipped
 
 
 class Day(Bucket):
     """A day contains entries"""
 
     tocdepth = 2
-    sort_entries = True
 
     @property
     def nice_name(self):
@@ -160,13 +216,36 @@ class Day(Bucket):
 
 @total_ordering
 class Tag(Bucket):
-    """A tag contains entries"""
+    """A tag contains entries
+
+    Big tags are split over multiple pages: ``tags/python.txt``,
+    ``tags/python/page-2.txt`` and so on, with links to the previous/next
+    page. The extra pages get their own directory, so they can't collide
+    with a real tag like "python-2".
 
-    sort_entries = True
+    """
+
+    def __init__(self, name, directory, page_size=TAG_PAGE_SIZE):
+        super().__init__(name, directory)
+        self.page_size = page_size
 
     @property
     def filename(self):
-        return os.path.join(self.dir, f"tags/{self.name}.txt")
+        return self.page_filename(1)
+
+    def page_filename(self, number):
+        if number == 1:
+            return os.path.join(self.dir, f"tags/{self.name}.txt")
+        return os.path.join(self.dir, f"tags/{self.name}/page-{number}.txt")
+
+    def pages(self):
+        """Return the items split up into pages"""
+        if not self.page_size:
+            return [self.items]
+        return [
+            self.items[start : start + self.page_size]
+            for start in range(0, len(self.items), self.page_size)
+        ] or [[]]
 
     def create_file(self):
         if not os.path.exists(self.filename):
@@ -176,7 +255,55 @@ class Tag(Bucket):
             answer = input("Create it? (y/N)")
             if answer != "y":
                 sys.exit(1)
-        super().create_file()
+        pages = self.pages()
+        for number, items in enumerate(pages, start=1):
+            content = []
+            title = self.nice_name
+            if number > 1:
+                # Only the first page is in the tag overview's toctree.
+                content.append(":orphan:")
+                content.append("")
+                title = f"{title} (page {number} of {len(pages)})"
+            content.append(title)
+            content.append("#" * len(title))
+            content.append("")
+            content += self.subitems(items, number)
+            content.append("")
+            content += self.page_links(number, len(pages))
+            page = self.page_filename(number)
+            os.makedirs(os.path.dirname(page), exist_ok=True)
+            write_if_changed(page, "\n".join(content))
+        self.remove_old_pages(len(pages))
+
+    def page_links(self, number, number_of_pages):
+        """Return links to the newer/older page (if there are more pages)"""
+        if number_of_pages == 1:
+            return []
+        links = []
+        if number > 1:
+            newer = self.page_link(number, number - 1)
+            links.append(f":doc:`« Newer entries <{newer}>`")
+        if number < number_of_pages:
+            older = self.page_link(number, number + 1)
+            links.append(f":doc:`Older entries » <{older}>`")
+        return [" | ".join(links), ""]
+
+    def page_link(self, number, target):
+        """Return the docname of page target, relative to page number"""
+        start = os.path.dirname(self.page_filename(number))
+        return os.path.relpath(self.page_filename(target), start)[:-4]
+
+    def remove_old_pages(self, number_of_pages):
+        """Remove pages left over from when the tag had more entries"""
+        number = number_of_pages + 1
+        while os.path.exists(self.page_filename(number)):
+            page = self.page_filename(number)
+            os.remove(page)
+            print(f"Removed {page}")
+            number += 1
+        if number_of_pages == 1 and number > 2:
+            # Only the (now empty) directory of the extra pages is left.
+            os.rmdir(os.path.dirname(self.page_filename(2)))
 
     def __lt__(self, other):
         return self.size < other.size
@@ -184,17 +311,20 @@ class Tag(Bucket):
     def __eq__(self, other):
         return self.size == other.size
 
-    def subitems(self):
+    def subitems(self, items=None, number=1):
         """Return link block at the start of the page"""
+        if items is None:
+            items = self.items
+        # "..", or "../.." from the directory of the extra pages.
+        up = os.path.relpath(self.dir, os.path.dirname(self.page_filename(number)))
         result = []
         result.append(".. toctree::")
         result.append(f"    :maxdepth: {self.tocdepth}")
         result.append("")
-        self.items.sort()
-        for item in self.items:
+        for item in items:
             link = item.filename.replace(self.dir, "")
             link = link.lstrip("/")
-            result.append(f"    {item.ymd} {item.title} <../{link}>")
+            result.append(f"    {item.ymd} {item.title} <{up}/{link}>")
         return result
 
 
@@ -206,52 +336,84 @@ class Entry:
 
     """
 
-    def __init__(self, filepath):
+    def __init__(self, filepath, stat=None, cache=None, render_cache=None, lazy=False):
         self.filename = filepath
-        self.lines = utf8_open(filepath).read().split("\n")
-        self.title = self.lines[0].strip()
-        tagline = [line for line in self.lines if TAGSTART in line]
-        self.tags = []
-        if tagline:
-            tagline = tagline[0].replace(TAGSTART, "")
-            self.tags = tagline.split(",")
-            self.tags = [tag.strip() for tag in self.tags]
+        self.lazy = lazy
+        self.render_cache = render_cache
+        self.rendered = None
+        self._lines = None
+        if stat is None:
+            stat = os.stat(filepath)
+        metadata = cache.lookup(filepath, stat) if cache else None
+        if metadata is None:
+            metadata = self.extract_metadata()
+            if cache:
+                cache.store(filepath, stat, metadata)
+        self.title = metadata["title"]
+        self.tags = metadata["tags"]
+        # yyyy-mm-dd date, taken from the path. Sorting uses it a lot, so we
+        # calculate it once.
+        parts = self.filename.split("/")
+        self.ymd = f"{parts[-4]}-{parts[-3]}-{parts[-2]}"
+        # Same day? Then the filename decides.
+        self.sort_key = (self.ymd, self.filename)
         # modification time
-        self.last_modified = time.gmtime(os.path.getmtime(self.filename))
+        self.last_modified = time.gmtime(stat.st_mtime)
         self.last_modified = time.strftime("%Y-%m-%dT%H:%M", self.last_modified)
 
+    def extract_metadata(self):
+        """Return title and tags (the only things we cache) from the file"""
+        if self.lazy and self._lines is None:
+            lines = self.header_lines()
+        else:
+            lines = self.lines
+        title = lines[0].strip()
+        tagline = [line for line in lines if TAGSTART in line]
+        tags = []
+        if tagline:
+            tagline = tagline[0].replace(TAGSTART, "")
+            tags = tagline.split(",")
+            tags = [tag.strip() for tag in tags]
+        return {"title": title, "tags": tags}
+
+    def header_lines(self):
+        """Return just the title and the tags line, without reading everything
+
+        The tags directive is normally right below the title, so we can stop
+        reading there and leave the rest of the entry alone.
+
+        """
+        header = []
+        with utf8_open(self.filename) as entry_file:
+            for line in entry_file:
+                line = line.rstrip("\n")
+                if TAGSTART in line:
+                    header.append(line)
+                    break
+                if len(header) < 2:
+                    header.append(line)
+        return header or [""]
+
+    @property
+    def lines(self):
+        """Return the lines of the file, read only when we actually need them"""
+        if self._lines is None:
+            self._lines = utf8_open(self.filename).read().split("\n")
+        return self._lines
+
     def __lt__(self, other):
         # Note: we want everything ordered with the *newest* on top.
-        # So "less than" means "we're less new"
-        if self.ymd < other.ymd:
-            # We're older, so "less new".
-            return False
-        if self.ymd > other.ymd:
-            # We're definitively newer!
-            return True
-        # Hm. Same day. Now look at the (reverse) modification time.
-        return other.filename < self.filename
+        # So "less than" means "we're newer".
+        return self.sort_key > other.sort_key
 
     def __eq__(self, other):
-        if other.ymd != self.ymd:
-            return False
-        # Same day, so it looks equal. Now look at the modification time.
-        return other.filename == self.filename
-
-    @property
-    def ymd(self):
-        """Return yyyy-mm-dd date"""
-        parts = self.filename.split("/")
-        day = parts[-2]
-        month = parts[-3]
-        year = parts[-4]
-        return f"{year}-{month}-{day}"
+        return self.sort_key == other.sort_key
 
-    def assign_to_tags(self, tag_dict, weblogdir):
+    def assign_to_tags(self, tag_dict, weblogdir, page_size=TAG_PAGE_SIZE):
         """Append ourself to tags"""
         for tag in self.tags:
             if tag not in tag_dict:
-                tag_dict[tag] = Tag(tag, weblogdir)
+                tag_dict[tag] = Tag(tag, weblogdir, page_size=page_size)
             tag_dict[tag].append(self)
 
     @property
@@ -264,23 +426,99 @@ class Entry:
         )
 
     @property
-    def atom_content(self):
-        """Return rendered html for atom content"""
+    def atom_source(self):
+        """Return the restructuredtext that ends up in the atom feed"""
         # Filter out first two lines (title and underline)
         lines = self.lines[2:]
         lines = [line for line in lines if ".. tags::" not in line]
-        # render to html
-        html_writer = Writer()
-        content = publish_parts("\n".join(lines), writer=html_writer)
-        html = content["html_body"]
-        html = html.replace("&nbsp;", " ")
+        return "\n".join(lines)
+
+    @property
+    def atom_content(self):
+        """Return rendered html for atom content
+
+        Rendering with docutils is slow, so we use the render cache (if
+        available): an entry is only rendered again after it is edited.
+
+        """
+        if self.rendered is not None:
+            return self.rendered
+        source = self.atom_source
+        if self.render_cache is None:
+            self.rendered = render_html(source)
+            return self.rendered
+        html = self.render_cache.lookup(source)
+        if html is None:
+            html = render_html(source)
+            self.render_cache.store(source, html)
+        self.rendered = html
         return html
 
 
+class EntryIndex:
+    """All entries, sorted once on their precomputed sort key
+
+    Iterating gives the newest entries first.
+
+    """
+
+    def __init__(self, entries):
+        # Oldest first internally, so that we can bisect on the dates.
+        self.entries = sorted(entries, key=attrgetter("sort_key"))
+        self.ymds = [entry.ymd for entry in self.entries]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return reversed(self.entries)
+
+    def newest(self, number):
+        """Return the newest entries, newest first"""
+        return self.entries[-number:][::-1] if number else []
+
+    def between(self, start, end):
+        """Return entries from yyyy-mm-dd start up to and including end
+
+        Newest first. ``start`` and ``end`` may also be shorter, like
+        ``2010`` or ``2010-03``.
+
+        """
+        first = bisect.bisect_left(self.ymds, start)
+        # "~" sorts after digits and dashes, so "2010-03~" is after every
+        # day in march 2010.
+        last = bisect.bisect_right(self.ymds, end + "~")
+        return self.entries[first:last][::-1]
+
+
 class Weblog:
     """Wrapper around weblog dir"""
 
-    def __init__(self, rootdir):
+    def __init__(
+        self,
+        rootdir,
+        read_workers=READ_WORKERS,
+        render_workers=RENDER_WORKERS,
+        lazy_entries=True,
+        incremental=False,
+        tag_page_size=TAG_PAGE_SIZE,
+        shallow_toctrees=False,
+    ):
+        # Shallow: year/month toctrees with maxdepth 1 instead of 4/3.
+        self.shallow_toctrees = shallow_toctrees
+        self.tag_page_size = tag_page_size
+        # Incremental: only regenerate index/tag pages whose entries changed.
+        self.incremental = incremental
+        self.read_workers = read_workers
+        # Lazy entries only read their header; the rest is read when needed.
+        self.lazy_entries = lazy_entries
+        self.render_workers = render_workers
+        self.entry_cache = MetadataCache(cache_file("weblog-entries.json", rootdir))
+        self.render_cache = RenderCache(
+            cache_file("weblog-html.json", rootdir),
+            dependencies=[os.path.join(rootdir, "source", SMUGMUG_MANIFEST)],
+        )
+        self.membership = JsonCache(cache_file("weblog-membership.json", rootdir))
         self.weblogdir = os.path.join(rootdir, "source", "weblog")
         if "weblog" in self.weblogdir:
             self.name = "Reinout van Rees' weblog"
@@ -290,53 +528,224 @@ class Weblog:
         self.tags = {}
         self.years = []
         self.all_entries = []
+        self.index = EntryIndex([])
 
-    def assign_entries(self):  # noqa: C901
+    def assign_entries(self):
         """Assign all found entries to their year and tag"""
-        for yearname in sorted(os.listdir(self.weblogdir)):
-            try:
-                int(yearname)
-            except ValueError:
-                continue
-            yeardir = os.path.join(self.weblogdir, yearname)
+        days = []
+        for yearname, yeardir in numbered_subdirs(self.weblogdir):
             year = Year(yearname, yeardir)
+            if self.shallow_toctrees:
+                year.tocdepth = 1
             self.years.append(year)
-            for monthname in sorted(os.listdir(yeardir)):
-                try:
-                    int(monthname)
-                except ValueError:
-                    continue
-                monthdir = os.path.join(yeardir, monthname)
+            for monthname, monthdir in numbered_subdirs(yeardir):
                 month = Month(monthname, monthdir)
+                if self.shallow_toctrees:
+                    month.tocdepth = 1
                 year.append(month)
-                for dayname in sorted(os.listdir(monthdir)):
-                    try:
-                        int(dayname)
-                    except ValueError:
-                        continue
-                    daydir = os.path.join(monthdir, dayname)
+                for dayname, daydir in numbered_subdirs(monthdir):
                     day = Day(dayname, daydir)
                     month.append(day)
-                    for entryname in os.listdir(daydir):
-                        if entryname == "index.txt":
-                            continue
-                        if entryname.endswith(".txt"):
-                            path = os.path.join(daydir, entryname)
-                            entry = Entry(path)
-                            entry.assign_to_tags(self.tags, self.weblogdir)
-                            day.append(entry)
-                            self.all_entries.append(entry)
+                    days.append(day)
+
+        def read_entry(found):
+            _day, path, stat = found
+            return Entry(
+                path,
+                stat=stat,
+                cache=self.entry_cache,
+                render_cache=self.render_cache,
+                lazy=self.lazy_entries,
+            )
+
+        with ThreadPoolExecutor(max_workers=self.read_workers) as executor:
+            found = []
+            for day, files in zip(
+                days, executor.map(lambda day: entry_files(day.dir), days)
+            ):
+                found += [(day, path, stat) for path, stat in files]
+            # executor.map() keeps the order, so we get the same order as a
+            # sorted serial walk would give us: oldest first.
+            entries = list(executor.map(read_entry, found))
+        self.all_entries = entries
+        self.index = EntryIndex(entries)
+        # Fill the tags and days newest first, that way they don't need to
+        # sort themselves.
+        for (day, _path, _stat), entry in zip(reversed(found), reversed(entries)):
+            entry.assign_to_tags(
+                self.tags, self.weblogdir, page_size=self.tag_page_size
+            )
+            day.append(entry)
+        self.entry_cache.prune()
+        self.entry_cache.save()
+
+    def day_bucket(self, daydir):
+        """Return the Day bucket for the directory, creating it if needed"""
+        monthdir = os.path.dirname(daydir)
+        yeardir = os.path.dirname(monthdir)
+        buckets = self.years
+        for bucket_class, directory in [
+            (Year, yeardir),
+            (Month, monthdir),
+            (Day, daydir),
+        ]:
+            name = os.path.basename(directory)
+            for bucket in buckets:
+                if bucket.name == name:
+                    break
+            else:
+                bucket = bucket_class(name, directory)
+                if self.shallow_toctrees and bucket_class is not Day:
+                    bucket.tocdepth = 1
+                bisect.insort(buckets, bucket, key=attrgetter("name"))
+            buckets = bucket.items
+        return bucket
+
+    def update_entries(self, paths):
+        """Re-read added, changed and removed entry files
+
+        The entry is replaced in its day and its tags, so that we don't have
+        to scan and read the whole weblog again. Return the tags of the old
+        and new versions of the entries.
+
+        """
+        by_filename = {entry.filename: entry for entry in self.all_entries}
+        changed_tags = set()
+        for path in paths:
+            old = by_filename.pop(path, None)
+            if old is not None:
+                changed_tags.update(old.tags)
+                self.day_bucket(os.path.dirname(path)).items.remove(old)
+                for tag in old.tags:
+                    self.tags[tag].items.remove(old)
+                    if not self.tags[tag].items:
+                        del self.tags[tag]
+            if not os.path.exists(path):
+                continue
+            new = Entry(
+                path,
+                cache=self.entry_cache,
+                render_cache=self.render_cache,
+                lazy=self.lazy_entries,
+            )
+            by_filename[path] = new
+            changed_tags.update(new.tags)
+            # Items are kept newest first, which is what Entry's "<" sorts on.
+            bisect.insort(self.day_bucket(os.path.dirname(path)).items, new)
+            for tag in new.tags:
+                if tag not in self.tags:
+                    self.tags[tag] = Tag(tag, self.weblogdir, self.tag_page_size)
+                bisect.insort(self.tags[tag].items, new)
+        self.index = EntryIndex(by_filename.values())
+        self.all_entries = self.index.entries
+        self.entry_cache.save()
+        return changed_tags
+
+    def buckets(self):
+        """Yield all year, month and day buckets"""
+        for year in self.years:
+            yield year
+            for month in year.items:
+                yield month
+                yield from month.items
+
+    def create_changed_files(self, changed_tags, granularity=stats.MONTH):
+        """Regenerate what update_entries() changed, not everything
+
+        Only the dirty buckets and the feeds with the changed tags are
+        written. The statistics only change when entries are added or
+        removed.
+
+        """
+        dirty = self.dirty_buckets()
+        # Added or removed entries, not just edited ones?
+        added_or_removed = self.membership.data.get("entries", {}).keys() != {
+            entry.filename for entry in self.all_entries
+        }
+        for bucket in itertools.chain(self.tags.values(), self.buckets()):
+            if dirty is None or bucket.filename in dirty:
+                bucket.create_file()
+        self.save_membership()
+        self.homepage()
+        self.tagpage()
+        self.navigation()
+        self.create_atom(
+            feeds=[
+                feed for feed in FEEDS if feed.tags is None or feed.tags & changed_tags
+            ]
+        )
+        self.create_for_homepage()
+        if added_or_removed:
+            self.create_stats(granularity=granularity)
 
     def create_files(self):
+        dirty = self.dirty_buckets() if self.incremental else None
+        skipped = 0
         for tag in self.tags.values():
-            tag.create_files()
+            skipped += tag.create_files(dirty)
         for year in self.years:
-            year.create_files()
+            skipped += year.create_files(dirty)
+        if self.incremental:
+            print(f"Skipped {skipped} unchanged index/tag pages")
+        self.save_membership()
         self.homepage()
         self.tagpage()
+        self.navigation()
         # TODO: tag cloud?
         # TODO: tag cloud of last 50 entries?
 
+    def current_membership(self):
+        return {
+            "settings": {
+                "tag_page_size": self.tag_page_size,
+                "shallow_toctrees": self.shallow_toctrees,
+            },
+            "entries": {
+                entry.filename: {"title": entry.title, "tags": entry.tags}
+                for entry in self.all_entries
+            },
+        }
+
+    def dirty_buckets(self):
+        """Return filenames of buckets whose entries changed since last run
+
+        Added and removed entries change their day/month/year pages. Changed
+        titles and tags only matter for the (old and new) tag pages.
+
+        Changed settings (tag page size, shallow toctrees) affect every page: then we
+        return None, which means "everything is dirty".
+
+        """
+        current = self.current_membership()
+        if self.membership.data.get("settings") != current["settings"]:
+            return None
+        previous = self.membership.data["entries"]
+        current = current["entries"]
+        dirty = set()
+        for filename in previous.keys() | current.keys():
+            old = previous.get(filename)
+            new = current.get(filename)
+            if old == new:
+                continue
+            tags = set(old["tags"] if old else []) | set(new["tags"] if new else [])
+            for tag in tags:
+                dirty.add(Tag(tag, self.weblogdir).filename)
+            if old is None or new is None:
+                daydir = os.path.dirname(filename)
+                monthdir = os.path.dirname(daydir)
+                yeardir = os.path.dirname(monthdir)
+                for directory in [daydir, monthdir, yeardir]:
+                    dirty.add(os.path.join(directory, "index.txt"))
+        return dirty
+
+    def save_membership(self):
+        """Remember which entries (with which title/tags) we generated for"""
+        current = self.current_membership()
+        if current != self.membership.data:
+            self.membership.data = current
+            self.membership.changed = True
+        self.membership.save()
+
     def homepage(self):
         content = []
         content.append(self.name)
@@ -346,7 +755,40 @@ class Weblog:
         content.append("")
         content += self.overview()
         filename = os.path.join(self.weblogdir, "index.txt")
-        conditional_write(filename, "\n".join(content))
+        write_if_changed(filename, "\n".join(content))
+
+    def navigation(self):
+        """Write previous/next entry info for the sphinx extension
+
+        rvo.rst reads it and adds ``weblog_prev`` and ``weblog_next`` to the
+        page context of every weblog entry. That way entries stay navigable
+        even with shallow year/month toctrees.
+
+        """
+        result = {}
+        previous = None
+        # Oldest first.
+        for entry in self.index.entries:
+            docname = self.docname(entry)
+            result[docname] = {"prev": None, "next": None}
+            if previous is not None:
+                previous_docname, previous_title = previous
+                result[docname]["prev"] = {
+                    "docname": previous_docname,
+                    "title": previous_title,
+                }
+                result[previous_docname]["next"] = {
+                    "docname": docname,
+                    "title": entry.title,
+                }
+            previous = (docname, entry.title)
+        filename = os.path.join(self.weblogdir, NAVIGATION_FILENAME)
+        write_if_changed(filename, json.dumps(result, indent=1, sort_keys=True))
+
+    def docname(self, entry):
+        """Return sphinx docname, like ``weblog/2010/03/14/entry``"""
+        path = os.path.relpath(entry.filename, self.weblogdir)
+        return "weblog/" + path[: -len(".txt")]
 
     def tagpage(self):
         content = []
@@ -363,14 +805,12 @@ class Weblog:
             content.append(f"    {tag.name} ({tag.size}) <{tag.name}.txt>")
         content.append("")
         filename = os.path.join(self.weblogdir, "tags/index.txt")
-        conditional_write(filename, "\n".join(content))
+        write_if_changed(filename, "\n".join(content))
 
     def subitems(self):
         """Show most recent weblog entries"""
         result = []
-        entries = self.all_entries[-NUM_RECENT_ENTRIES:]
-        entries.sort()
-        for entry in entries:
+        for entry in self.index.newest(NUM_RECENT_ENTRIES):
             parts = entry.filename.split("/")
             link = "/".join(parts[-4:])
             link = link.replace(".txt", ".html")
@@ -408,225 +848,204 @@ class Weblog:
         result.append("    tags/index.txt")
         return result
 
-    def create_atom(self):
-        all_entries = self.all_entries
-        all_entries.sort()
-        all_entries.reverse()
-        atom_templ = jinja_env.get_template("atom.xml")
-        # Main atom file
-        last_10 = all_entries[-10:]
-        last_10.reverse()
-        target_name = os.path.join(self.target_dir, "atom.xml")
-        utf8_open(target_name, "w").write(
-            atom_templ.render(
-                base_url=self.base_url,
-                title=self.name,
-                subtitle=self.subtitle,
-                feedfile="atom.xml",
-                entries=last_10,
-                updated=latest_update(last_10),
-            )
-        )
-        # Planet plone + planet zope
-        plone_entries = [
-            entry
-            for entry in all_entries
-            if (
-                "plone" in entry.tags
-                or "grok" in entry.tags
-                or "python" in entry.tags
-                or "pyramid" in entry.tags
-                or "buildout" in entry.tags
-                or "zope" in entry.tags
-            )
-        ]
-        if plone_entries:  # Not in preken weblog ;-)
-            plone_entries = plone_entries[-10:]
-            plone_entries.reverse()
-            target_name = os.path.join(self.target_dir, "plonefeed.xml")
-            utf8_open(target_name, "w").write(
-                atom_templ.render(
-                    base_url=self.base_url,
-                    title=self.name,
-                    feedfile="plonefeed.xml",
-                    subtitle=self.subtitle,
-                    entries=plone_entries,
-                    updated=latest_update(plone_entries),
-                )
-            )
-        # planet python
-        # Planet plone
-        python_entries = [
-            entry
-            for entry in all_entries
-            if (
-                "plone" in entry.tags
-                or "grok" in entry.tags
-                or "python" in entry.tags
-                or "buildout" in entry.tags
-                or "django" in entry.tags
-                or "pyramid" in entry.tags
-                or "djangocon" in entry.tags
-                or "zope" in entry.tags
-            )
-        ]
-        if python_entries:  # Not in preken weblog ;-)
-            python_entries = python_entries[-10:]
-            python_entries.reverse()
-            target_name = os.path.join(self.target_dir, "pythonfeed.xml")
-            utf8_open(target_name, "w").write(
+    def create_atom(self, feeds=FEEDS):
+        atom_templ = get_template("atom.xml")
+        feed_entries = fill_feeds(feeds, self.index)
+        # Render all html in one go, so that it can happen in parallel.
+        self.render_entries(itertools.chain(*feed_entries.values()))
+        for feed in feeds:
+            entries = feed_entries[feed.filename]
+            if not entries:  # Not in preken weblog ;-)
+                continue
+            target_name = os.path.join(self.target_dir, feed.filename)
+            write_if_changed(
+                target_name,
                 atom_templ.render(
                     base_url=self.base_url,
-                    title=self.name,
+                    title=feed.title or self.name,
                     subtitle=self.subtitle,
-                    feedfile="pythonfeed.xml",
-                    entries=python_entries,
-                    updated=latest_update(python_entries),
-                )
+                    feedfile=feed.filename,
+                    entries=entries,
+                    updated=latest_update(entries),
+                ),
             )
+        self.render_cache.prune()
+        self.render_cache.save()
 
-        django_entries = [
-            entry
-            for entry in all_entries
-            if "django" in entry.tags
-            or "python" in entry.tags
-            or "book" in entry.tags
-            or "djangocon" in entry.tags
-        ]
-        if django_entries:
-            django_entries = django_entries[-10:]
-            django_entries.reverse()
-            target_name = os.path.join(self.target_dir, "djangofeed.xml")
-            utf8_open(target_name, "w").write(
-                atom_templ.render(
-                    base_url=self.base_url,
-                    title=self.name,
-                    subtitle=self.subtitle,
-                    feedfile="djangofeed.xml",
-                    entries=django_entries,
-                    updated=latest_update(django_entries),
-                )
-            )
+    def render_entries(self, entries):
+        """Render the atom html of the entries, in parallel where needed
+
+        Docutils is CPU-bound, so html that isn't in the render cache yet is
+        rendered in a process pool. The result is stored on the entries and
+        in the render cache.
+
+        """
+        todo = {}
+        for entry in entries:
+            if entry.rendered is not None:
+                continue
+            source = entry.atom_source
+            if source in todo:
+                # Same entry in multiple feeds.
+                todo[source].append(entry)
+                continue
+            html = self.render_cache.lookup(source)
+            if html is None:
+                todo.setdefault(source, []).append(entry)
+            else:
+                entry.rendered = html
+        if not todo:
+            return
+        sources = list(todo)
+        if self.render_workers == 1 or len(sources) == 1:
+            htmls = [render_html(source) for source in sources]
+        else:
+            from rvo.rst import setup_for_plain_docutils
+
+            # Not the default "fork": "rvo build" calls us from a thread, and
+            # forking a multi-threaded process can deadlock the child.
+            with ProcessPoolExecutor(
+                max_workers=self.render_workers,
+                initializer=setup_for_plain_docutils,
+                mp_context=multiprocessing.get_context("forkserver"),
+            ) as executor:
+                htmls = list(executor.map(render_html, sources))
+        for source, html in zip(sources, htmls):
+            self.render_cache.store(source, html)
+            for entry in todo[source]:
+                entry.rendered = html
 
     def create_for_homepage(self):
-        """Create html snippet for inclusion in homepage"""
-        self.all_entries.sort()
-        self.all_entries.reverse()
-        snippet_templ = jinja_env.get_template("homepagesnippet.html")
+        """Create html snippet for inclusion in homepage and return it"""
+        snippet_templ = get_template("homepagesnippet.html")
         # Main atom file
-        last_5 = self.all_entries[-5:]
-        last_5.reverse()
+        last_5 = self.index.newest(5)
         target_name = os.path.join(self.target_dir, "snippet.html")
-        utf8_open(target_name, "w").write(
-            snippet_templ.render(base_url=self.base_url, entries=last_5)
-        )
+        snippet = snippet_templ.render(base_url=self.base_url, entries=last_5)
+        write_if_changed(target_name, snippet)
+        return snippet
 
-    def create_stats(self):
+    def create_stats(self, granularity=stats.MONTH):
         """Create html page with statistics"""
-        statistic_templ = jinja_env.get_template("statistics.html")
+        statistic_templ = get_template("statistics.html")
         target_name = os.path.join(self.target_dir, "statistics.html")
-        years = [{"name": year.name, "number": len(year)} for year in self.years]
-
-        maximum = max([y["number"] for y in years])
-        base = "http://chart.apis.google.com/chart?"
-        size = "chs=700x200"
-        colors = "chco=4444FF"
-        data = "chd=t:{}".format(",".join([str(y["number"]) for y in years]))
-        maxmin = f"chds=0,{int(maximum)}"
-        type_ = "cht=bvg"
-        axis_def = "chxt=x,y"
-        x = "|".join([str(y["name"]) for y in years])
-        axis_val = f"chxl=0:|{x}|1:|0|{int(maximum)}"
-        yeargraph = base + "&amp;".join(
-            [size, colors, data, maxmin, type_, axis_def, axis_val]
+        ymds = self.index.ymds
+        month_labels, month_counts = stats.period_counts(ymds)
+        if not month_counts:
+            return
+        years = [
+            {"name": str(year), "number": number}
+            for year, number in stats.year_counts(month_labels, month_counts)
+        ]
+        yeargraph = stats.bar_chart(
+            [year["name"] for year in years], [year["number"] for year in years]
         )
 
-        months = []
-        for year in self.years:
-            available_months = {month.name: month for month in year.items}
-            for month_name in MONTH_NAMES:
-                if month_name in available_months:
-                    month = available_months[month_name]
-                    months.append(
-                        {
-                            "name": " ".join([month.name, year.name]),
-                            "month": month.name,
-                            "year": year.name,
-                            "number": len(month),
-                        }
-                    )
-                else:
-                    # Empty month...
-                    months.append(
-                        {
-                            "name": f"{month_name} {year.name}",
-                            "month": month_name,
-                            "year": year.name,
-                            "number": 0,
-                        }
-                    )
-
-        average = float(months[0]["number"])
-        ratio = 0.2
-        maximum = 0
-        for month in months:
-            amount = month["number"]
-            if amount > maximum:
-                maximum = amount
-            average = average + ratio * amount
-            average = average / (1.0 + ratio)
-            month["average"] = average
-        global_average = sum([month["number"] for month in months])
-        global_average = global_average / len(months)
-        base = "http://chart.apis.google.com/chart?"
-        size = "chs=700x300"
-        colors = "chco=BBBBFF,4444FF,BBBBBB"
-        data = "chd=t:{}|{}|{}".format(
-            ",".join([str(m["number"]) for m in months]),
-            ",".join([str(round(m["average"])) for m in months]),
-            ",".join([str(global_average) for m in months]),
-        )
-        maxmin = f"chds=0,{int(maximum)},0,{int(maximum)},0,{int(maximum)}"
-        linestyle = "chls=1,1,0|5,1,0|1,1,0"
-        type_ = "cht=lc"
-        legend = "chdl=posts+per+month|moving+average|average"
-        axis_def = "chxt=x,x,y"
-        in_between = len(months) / 4.0
-        x1 = []
-        x2 = []
-        for i in range(5):
-            index = int(round(i * in_between))
-            if index >= len(months):
-                index = len(months) - 1
-            x1.append(months[index]["month"])
-            x2.append(months[index]["year"])
-        x1 = "|".join(x1)
-        x2 = "|".join(x2)
-        axis_val = f"chxl=0:|{x1}|1:|{x2}|2:|0|{maximum}"
-        monthgraph = base + "&amp;".join(
-            [size, colors, data, maxmin, type_, linestyle, legend, axis_def, axis_val]
+        if granularity == stats.MONTH:
+            labels, counts = month_labels, month_counts
+        else:
+            labels, counts = stats.period_counts(ymds, granularity)
+        averages = stats.moving_average(counts)
+        global_average = sum(counts) / len(counts)
+        maximum = max(counts)
+        months = [
+            {"name": stats.label_text(label), "number": number, "average": average}
+            for label, number, average in zip(labels, counts, averages)
+        ]
+        monthgraph = stats.line_chart(
+            [
+                (f"posts per {granularity}", counts, "#BBBBFF", 1),
+                ("moving average", averages, "#4444FF", 5),
+                ("average", [global_average] * len(counts), "#BBBBBB", 1),
+            ],
+            stats.ticks(labels),
         )
 
-        utf8_open(target_name, "w").write(
+        write_if_changed(
+            target_name,
             statistic_templ.render(
                 years=years,
                 yeargraph=yeargraph,
                 months=months,
                 maximum=maximum,
                 monthgraph=monthgraph,
-            )
+            ),
         )
 
 
 def main():
-    if len(sys.argv) < 2:
-        print("Missing root dir of sphinx (with source/, build/ and so)")
-        sys.exit(1)
-    weblogdir = sys.argv[1]
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "rootdir", help="root dir of sphinx (with source/, build/ and so)"
+    )
+    parser.add_argument(
+        "--clear-cache",
+        action="store_true",
+        help="forget the cached entry metadata and read every entry again",
+    )
+    parser.add_argument(
+        "--read-workers",
+        type=int,
+        default=READ_WORKERS,
+        help="number of threads for reading entries (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--render-workers",
+        type=int,
+        default=RENDER_WORKERS,
+        help="number of processes for rendering feed html (default: #cpus)",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only regenerate index and tag pages whose entries changed",
+    )
+    parser.add_argument(
+        "--tag-page-size",
+        type=int,
+        default=TAG_PAGE_SIZE,
+        help="entries per tag page, 0 for no pagination (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--shallow-toctrees",
+        action="store_true",
+        help="year/month pages only list their months/days, not every entry",
+    )
+    parser.add_argument(
+        "--stats-per-day",
+        action="store_true",
+        help="chart posts per day instead of per month on the statistics page",
+    )
+    options = parser.parse_args()
+    from rvo.rst import setup_for_plain_docutils
+
     setup_for_plain_docutils()
-    weblog = Weblog(weblogdir)
-    weblog.assign_entries()
-    weblog.create_files()
-    weblog.create_atom()
-    weblog.create_for_homepage()
-    weblog.create_stats()
+    weblog = Weblog(
+        options.rootdir,
+        read_workers=options.read_workers,
+        render_workers=options.render_workers,
+        incremental=options.incremental,
+        tag_page_size=options.tag_page_size,
+        shallow_toctrees=options.shallow_toctrees,
+    )
+    if options.clear_cache:
+        weblog.entry_cache.invalidate()
+        weblog.render_cache.invalidate()
+        weblog.membership.invalidate()
+    instrumentation = Instrumentation("weblog")
+    with instrumentation.stage("assign_entries"):
+        weblog.assign_entries()
+    print(weblog.entry_cache.report())
+    with instrumentation.stage("create_files"):
+        weblog.create_files()
+    with instrumentation.stage("create_atom"):
+        weblog.create_atom()
+    print(weblog.render_cache.report())
+    with instrumentation.stage("create_for_homepage"):
+        weblog.create_for_homepage()
+    with instrumentation.stage("create_stats"):
+        weblog.create_stats(
+            granularity=stats.DAY if options.stats_per_day else stats.MONTH
+        )
+    print(save_manifest())
+    instrumentation.save()